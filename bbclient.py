@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# asyncio client for the bulletin board protocol. One BulletinClient is one
+# connection; a process can run as many as it likes on the same event loop.
+#
+#     client = BulletinClient()
+#     await client.connect("127.0.0.1", 12345)
+#     await client.set_username("bot1")
+#     await client.join("group1")
+#     msg_id = await client.post("group1", "hello", "first post")
+#     async for event in client:
+#         ...
+import asyncio
+import itertools
+import json
+import socket
+import time
+
+from framing import LineFramer, FrameTooLarge
+
+DEFAULT_PORT = 12345
+PUBLIC_GROUP = "public"
+# the server may send back bodies up to its own limit plus JSON overhead
+MAX_FRAME = 4 << 20
+READ_SIZE = 1 << 16
+# bodies longer than this (bytes) are uploaded in chunks, see post_begin in
+# server.py; downloads switch to chunks when the server says so
+INLINE_BODY = 1 << 16
+DOWNLOAD_WINDOW = 8     # get_chunk requests kept in flight
+
+# the reply that completes each action; anything tagged with the same req
+# before it (history, info) is collected along the way
+FINAL_REPLY = {
+    "set_username": "groups",
+    "join": "users",
+    "post": "post",
+    "post_begin": "post_begin",
+    "post_chunk": "post_chunk",
+    "post_end": "post",
+    "get_chunk": "chunk",
+    "users": "users",
+    "groups": "groups",
+    "leave": "leave",
+    "get_message": "message",
+    "sync": "sync",
+    "stats": "stats",
+    "ack": "ack",
+    "unread": "unread",
+}
+
+
+# the socket path when host names a Unix domain socket ("unix:NAME" or a
+# path with a slash, see server.py --unix), otherwise None
+def unix_path(host):
+    if host.startswith("unix:"):
+        return host[len("unix:"):]
+    if "/" in host:
+        return host
+    return None
+
+
+class ServerError(Exception):
+    def __init__(self, reply):
+        super().__init__(reply.get("message", "server error"))
+        self.reply = reply
+        self.code = reply.get("code")
+        self.retry_after = reply.get("retry_after")
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+class BulletinClient:
+    def __init__(self, max_retries=8, max_events=10000, cache=None,
+                 auto_reconnect=False, reconnect_min=0.5, reconnect_max=30.0,
+                 trace_ack=False):
+        self.reader = None
+        self.writer = None
+        self.host = None
+        self.port = None
+        self.username = None
+        self.closed = True
+        # what a reconnect needs to put the session back together
+        self.resume_token = None
+        self.joined = set()
+        self.digest_groups = set()  # the joined groups in digest delivery mode
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        # rate_limited/overloaded replies are retried this many times, each
+        # retry waiting retry_after with exponential growth
+        self.max_retries = max_retries
+        self.backoff_until = 0.0
+        self.events_dropped = 0
+        # optional msgcache.MessageCache fed from everything we receive
+        self.cache = cache
+        # echo trace ids of traced posts back to the server (server --trace-file),
+        # and stamp those events with received_ns (time.monotonic_ns())
+        self.trace_ack = trace_ack
+        self._req_ids = itertools.count(1)
+        self._pending = {}   # req -> (future, frames so far, final command)
+        self.max_events = max_events
+        self._events = None
+        self._reader_task = None
+        self._reconnect_task = None
+        self._closing = False
+
+    # host may also be a Unix domain socket path, port is ignored then
+    async def connect(self, host="127.0.0.1", port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self._closing = False
+        self._events = asyncio.Queue(self.max_events)
+        await self._open()
+        return self
+
+    async def _open(self):
+        path = unix_path(self.host)
+        if path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def close(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            await asyncio.gather(self._reconnect_task, return_exceptions=True)
+        if self.cache is not None:
+            self.cache.save()
+        if not self.closed:
+            try:
+                self._send({"action": "exit"})
+                await self.writer.drain()
+            except (OSError, ConnectionError):
+                pass
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        self._end_events()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # unsolicited frames: events, the welcome, untagged errors. Ends when
+    # the connection closes.
+    async def events(self):
+        while True:
+            obj = await self._events.get()
+            if obj is None:
+                return
+            yield obj
+
+    def __aiter__(self):
+        return self.events()
+
+    def _send(self, obj):
+        if self.closed:
+            raise ConnectionClosed("not connected")
+        self.writer.write((json.dumps(obj) + "\n").encode("utf-8"))
+
+    def _end_events(self):
+        if self._events is None:
+            return
+        if self._events.full():
+            self._events.get_nowait()
+        self._events.put_nowait(None)
+
+    def _track_session(self, obj):
+        t = obj.get("type")
+        if t == "info" and obj.get("subtype") == "username_accepted":
+            self.username = obj.get("username", self.username)
+            self.resume_token = obj.get("resume_token", self.resume_token)
+            if obj.get("resumed"):
+                self.joined = set(obj.get("groups", []))
+        elif t == "history":
+            self.joined.add(obj.get("group"))
+        elif t == "response" and obj.get("command") == "leave":
+            self.joined.discard(obj.get("group"))
+            self.digest_groups.discard(obj.get("group"))
+
+    def _push_event(self, obj):
+        if self._events.full():
+            self._events.get_nowait()
+            self.events_dropped += 1
+        self._events.put_nowait(obj)
+
+    def _dispatch(self, obj):
+        t = obj.get("type")
+        if t == "ping":
+            self._send({"action": "pong"})
+            return
+        if self.trace_ack and t == "event" and "trace" in obj:
+            obj["received_ns"] = time.monotonic_ns()
+            self._send({"action": "trace_ack", "trace": obj["trace"]})
+        if self.cache is not None:
+            self.cache.observe(obj)
+        self._track_session(obj)
+        req = obj.get("req")
+        entry = self._pending.get(req) if req is not None else None
+        if entry is None:
+            self._push_event(obj)
+            return
+        fut, frames, final = entry
+        if t == "error":
+            del self._pending[req]
+            if not fut.done():
+                fut.set_exception(ServerError(obj))
+            return
+        frames.append(obj)
+        if t == "response" and obj.get("command") == final:
+            del self._pending[req]
+            if not fut.done():
+                fut.set_result(frames)
+
+    async def _read_loop(self):
+        framer = LineFramer(MAX_FRAME)
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                framer.feed(data)
+                while True:
+                    try:
+                        batch = framer.frames()
+                    except FrameTooLarge as e:
+                        self._push_event({"type": "error", "message": f"Dropped oversized frame: {e}"})
+                        continue
+                    if not batch:
+                        break
+                    for frame in batch:
+                        line = frame.strip()
+                        if not line:
+                            continue
+                        try:
+                            obj = json.loads(line)
+                        except ValueError:
+                            self._push_event({"type": "error", "message": "Invalid JSON from server"})
+                            continue
+                        self._dispatch(obj)
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            for fut, _, _ in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionClosed("connection closed"))
+            self._pending.clear()
+            if self._closing or not self.auto_reconnect:
+                self._end_events()
+            elif self._reconnect_task is None or self._reconnect_task.done():
+                self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.reconnect_min
+        while not self._closing:
+            self._push_event({"type": "info", "subtype": "reconnecting",
+                              "message": f"Connection lost, reconnecting in {delay:.1f}s"})
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+                resumed = await self._restore()
+            except ServerError as e:
+                # the server will not give us our name back, nothing to retry
+                self._push_event({"type": "error", "message": f"Reconnect failed: {e}"})
+                self._closing = True
+                self.writer.close()
+                self._end_events()
+                return
+            except (OSError, ConnectionError):
+                if self.writer is not None:
+                    self.writer.close()
+                delay = min(delay * 2, self.reconnect_max)
+                continue
+            how = "session resumed" if resumed else f"rejoined {len(self.joined)} groups"
+            self._push_event({"type": "info", "subtype": "reconnected", "resumed": resumed,
+                              "message": f"Reconnected, {how}"})
+            return
+
+    # runs on a fresh connection: resume the old session if the server still
+    # has it, otherwise log in again and rejoin every group in one request
+    async def _restore(self):
+        if self.username is None:
+            return False
+        fields = {"username": self.username}
+        if self.resume_token:
+            fields["resume"] = self.resume_token
+        frames = await self.request("set_username", **fields)
+        resumed = any(f.get("resumed") for f in frames if f.get("subtype") == "username_accepted")
+        groups = sorted(self.joined)
+        # what was posted while we were away arrives as history: replayed by
+        # the server on resume, or the join replies after since otherwise
+        history = []
+        if resumed:
+            history = frames
+        elif groups:
+            since = {}
+            if self.cache is not None:
+                for g in groups:
+                    last = self.cache.last_id(g)
+                    if last is not None:
+                        since[g] = last
+            # one join per delivery mode
+            digest = [g for g in groups if g in self.digest_groups]
+            live = [g for g in groups if g not in self.digest_groups]
+            if live:
+                history += await self.request("join", groups=live, since=since)
+            if digest:
+                history += await self.request("join", groups=digest, since=since, delivery="digest")
+        for f in history:
+            if f.get("type") != "history":
+                continue
+            self._push_event(f)
+            async for page, more in self._pages(f.get("group"), f.get("messages", []), f.get("more", False)):
+                self._push_event({"type": "history", "group": f.get("group"), "messages": page, "more": more})
+        return resumed
+
+    # sends one action and returns every frame tagged with its req, ending
+    # with the final reply. Raises ServerError on an error reply. Large post
+    # bodies are uploaded in chunks and chunked get_message replies are
+    # completed with the whole body, so callers never see the difference.
+    async def request(self, action, **fields):
+        if self.cache is not None:
+            group = fields.get("group", PUBLIC_GROUP)
+            if action == "get_message":
+                m = self.cache.get(group, fields.get("id"))
+                if m is not None:
+                    return [{"type": "response", "command": "message",
+                             "group": group, "message": m, "cached": True}]
+            elif action == "join" and "since" not in fields:
+                # only ask for what we missed since the last message we saw
+                last = self.cache.last_id(group)
+                if last is not None:
+                    fields["since"] = last
+        if action == "post" and len(str(fields.get("body", "")).encode("utf-8")) > INLINE_BODY:
+            return await self._upload(fields)
+        frames = await self._roundtrip(action, fields)
+        if action == "join":
+            joined = frames[-1].get("groups") or [fields.get("group", PUBLIC_GROUP)]
+            if fields.get("delivery") == "digest":
+                self.digest_groups.update(joined)
+            else:
+                self.digest_groups.difference_update(joined)
+        if action == "get_message" and frames[-1].get("chunked"):
+            frames[-1] = await self._download(frames[-1])
+        return frames
+
+    async def _roundtrip(self, action, fields):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            wait = self.backoff_until - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            req = next(self._req_ids)
+            fut = loop.create_future()
+            final = "join" if action == "join" and "groups" in fields else FINAL_REPLY.get(action)
+            self._pending[req] = (fut, [], final)
+            try:
+                self._send(dict(fields, action=action, req=req))
+                await self.writer.drain()
+                return await fut
+            except ServerError as e:
+                if e.retry_after is None or attempt == self.max_retries:
+                    raise
+                delay = float(e.retry_after) * (2 ** attempt)
+                self.backoff_until = max(self.backoff_until, loop.time() + delay)
+            finally:
+                self._pending.pop(req, None)
+
+    # runs the calls in order with at most window of them waiting at once
+    async def _windowed(self, calls, window):
+        sem = asyncio.Semaphore(window)
+        tasks = []
+
+        async def run(call):
+            try:
+                return await call
+            finally:
+                sem.release()
+        try:
+            for call in calls:
+                await sem.acquire()
+                tasks.append(asyncio.ensure_future(run(call)))
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+
+    async def _upload(self, fields):
+        body = str(fields.pop("body"))
+        size = len(body.encode("utf-8"))
+        begin = (await self._roundtrip("post_begin", dict(fields, size=size)))[-1]
+        upload = begin["upload"]
+        step = begin["chunk_size"]
+        chunks = (self._roundtrip("post_chunk", {"upload": upload, "seq": n, "data": body[i:i + step]})
+                  for n, i in enumerate(range(0, len(body), step)))
+        await self._windowed(chunks, begin["window"])
+        trace = {"trace": True} if fields.get("trace") else {}
+        return await self._roundtrip("post_end", dict(trace, upload=upload))
+
+    async def _download(self, reply):
+        m = reply["message"]
+        group = reply.get("group")
+        step = reply["chunk_size"]
+        pieces = (self._roundtrip("get_chunk", {"group": group, "id": m["id"], "offset": off})
+                  for off in range(0, reply["chars"], step))
+        frames = await self._windowed(pieces, DOWNLOAD_WINDOW)
+        full = dict(reply, message=dict(m, body="".join(f[-1]["data"] for f in frames)))
+        del full["chunked"]
+        if self.cache is not None:
+            self.cache.add(group, full["message"])
+        return full
+
+    async def set_username(self, username):
+        frames = await self.request("set_username", username=username)
+        self.username = username
+        return frames[-1].get("groups", [])
+
+    # delivery="digest": new posts arrive as periodic digest events
+    async def join(self, group=PUBLIC_GROUP, delivery=None):
+        fields = {"group": group}
+        if delivery:
+            fields["delivery"] = delivery
+        frames = await self.request("join", **fields)
+        history = []
+        more = False
+        for f in frames:
+            if f.get("type") == "history":
+                history = f.get("messages", [])
+                more = f.get("more", False)
+        async for page, _ in self._pages(group, history, more):
+            history.extend(page)
+        return {"history": history, "users": frames[-1].get("users", [])}
+
+    # a history frame stops at max_sync messages with "more": true; yields
+    # the rest a page at a time, each with whether more follow
+    async def _pages(self, group, msgs, more):
+        while more and msgs:
+            msgs, more = await self.sync(group, msgs[-1]["id"])
+            yield msgs, more
+
+    # messages after since, and whether there are more to fetch
+    async def sync(self, group, since):
+        frames = await self.request("sync", group=group, since=since)
+        return frames[-1].get("messages", []), frames[-1].get("more", False)
+
+    async def post(self, group, subject, body, trace=False):
+        fields = {"trace": True} if trace else {}
+        frames = await self.request("post", group=group, subject=subject, body=body, **fields)
+        return frames[-1]["id"]
+
+    async def users(self, group=PUBLIC_GROUP):
+        frames = await self.request("users", group=group)
+        return frames[-1].get("users", [])
+
+    async def groups(self):
+        frames = await self.request("groups")
+        return frames[-1].get("groups", [])
+
+    async def leave(self, group=PUBLIC_GROUP):
+        await self.request("leave", group=group)
+
+    async def get_message(self, group, msg_id):
+        frames = await self.request("get_message", group=group, id=msg_id)
+        return frames[-1].get("message", {})
+
+    # marks everything up to msg_id (default: all) in the group as read and
+    # returns how many messages are still unread there
+    async def ack(self, group, msg_id=None):
+        fields = {} if msg_id is None else {"id": msg_id}
+        frames = await self.request("ack", group=group, **fields)
+        return frames[-1].get("unread", 0)
+
+    # group -> {"unread": count, "first_unread": id or None}
+    async def unread(self):
+        frames = await self.request("unread")
+        return frames[-1].get("groups", {})
+
+    async def stats(self):
+        frames = await self.request("stats")
+        return frames[-1].get("stats", {})
+
+    async def shutdown(self):
+        self._send({"action": "shutdown"})
+        await self.writer.drain()
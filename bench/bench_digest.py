@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# fan-out with live and digest delivery: --members clients join one group,
+# --digest of them in digest mode, and one of them posts --posts messages
+# through handle_post. Counts the frames queued for the members (and the
+# bytes they encode to) and the post rate, for every member live and for
+# the given share in digest mode. Handlers are called in-process, with the
+# client fixtures from bench_handlers.py.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+from bench_handlers import make_client, reset
+
+GROUP = "group1"
+
+
+def setup(members, digest):
+    server.settings["rate_limits"] = {}
+    reset()
+    clients = [make_client(f"user{i}") for i in range(members)]
+    gdata = server.groups[GROUP]
+    # the poster is user0 and stays live
+    gdata["digest"].update(c.username for c in clients[1:digest + 1])
+    server.refresh_snapshot(gdata)
+    return clients
+
+
+# frames and bytes queued for the members other than the poster, then
+# thrown away
+def collect(clients, totals):
+    for c in clients:
+        with c.out_cond:
+            n = c.pending
+            frames = [f for lane in c.lanes for f in lane]
+            for lane in c.lanes:
+                lane.clear()
+            c.pending = 0
+        server.frames_dequeued(n)
+        if c.username == "user0":
+            continue
+        totals["frames"] += n
+        totals["bytes"] += sum(len(f[1]) for f in frames)
+
+
+def run(members, digest, posts, body):
+    clients = setup(members, digest)
+    poster = clients[0]
+    data = {"group": GROUP, "subject": "bench", "body": "x" * body}
+    totals = {"frames": 0, "bytes": 0}
+    # presence events from the setup are not part of the count
+    collect(clients, {"frames": 0, "bytes": 0})
+    elapsed = 0.0
+    for i in range(posts):
+        start = time.perf_counter()
+        server.handle_post(poster, data)
+        elapsed += time.perf_counter() - start
+        if i % 50 == 49:
+            collect(clients, totals)
+    # what the digest thread would send at the next tick
+    start = time.perf_counter()
+    server.flush_digest(GROUP)
+    elapsed += time.perf_counter() - start
+    collect(clients, totals)
+    reset()
+    return dict(totals, posts_per_s=posts / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fan-out frames with live vs digest delivery")
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--digest", type=int, default=199, help="members in digest mode")
+    parser.add_argument("--posts", type=int, default=2000)
+    parser.add_argument("--body", type=int, default=200, help="body size in bytes")
+    parser.add_argument("--digest-max", type=int, default=server.settings["digest_max"])
+    args = parser.parse_args()
+
+    server.settings["digest_max"] = args.digest_max
+    print(f"{args.members} members, {args.posts} posts, digests of up to {args.digest_max}")
+    print(f"{'digest members':<16}{'frames':>10}{'frames/post':>13}{'KiB':>10}{'posts/s':>10}")
+    results = []
+    for digest in (0, args.digest):
+        r = run(args.members, digest, args.posts, args.body)
+        results.append(r)
+        print(f"{digest:<16}{r['frames']:>10}{r['frames'] / args.posts:>13.2f}"
+              f"{r['bytes'] / 1024:>10.0f}{r['posts_per_s']:>10.0f}", flush=True)
+    live, mixed = results
+    print(f"frames x{live['frames'] / max(mixed['frames'], 1):.1f} fewer, "
+          f"bytes x{live['bytes'] / max(mixed['bytes'], 1):.1f} fewer")
+
+
+if __name__ == "__main__":
+    main()
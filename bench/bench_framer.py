@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# microbenchmarks for framing.LineFramer against sock.makefile("r") line
+# iteration: lines/s for a few line sizes, and memory held by an endless line
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from framing import LineFramer, FrameTooLarge, iter_frames
+
+
+def feeder(sock, payload, repeat):
+    for _ in range(repeat):
+        sock.sendall(payload)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def read_makefile(sock):
+    count = 0
+    for line in sock.makefile("r"):
+        line = line.strip()
+        if line:
+            count += 1
+    return count
+
+
+def read_framer(sock):
+    count = 0
+    for frame in iter_frames(sock, LineFramer()):
+        if frame.strip():
+            count += 1
+    return count
+
+
+def run(reader, line_size, lines):
+    a, b = socket.socketpair()
+    per_chunk = max(1, 65536 // (line_size + 1))
+    payload = (b"x" * line_size + b"\n") * per_chunk
+    repeat = max(1, lines // per_chunk)
+    t = threading.Thread(target=feeder, args=(a, payload, repeat), daemon=True)
+    start = time.perf_counter()
+    t.start()
+    count = reader(b)
+    elapsed = time.perf_counter() - start
+    t.join()
+    a.close()
+    b.close()
+    return count / elapsed
+
+
+def oversized_line(reader, size):
+    # peak memory while the peer streams a line that never ends
+    a, b = socket.socketpair()
+    payload = b"y" * 65536
+
+    def flood():
+        sent = 0
+        try:
+            while sent < size:
+                a.sendall(payload)
+                sent += len(payload)
+            a.sendall(b"\n")
+            a.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    t = threading.Thread(target=flood, daemon=True)
+    tracemalloc.start()
+    t.start()
+    try:
+        reader(b)
+    except FrameTooLarge:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    b.close()
+    a.close()
+    t.join()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LineFramer vs makefile microbenchmarks")
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--oversize", type=int, default=32 << 20)
+    args = parser.parse_args()
+
+    print(f"{'line bytes':>10}{'makefile lines/s':>20}{'framer lines/s':>18}")
+    for size in (64, 256, 1024, 8192):
+        mk = run(read_makefile, size, args.lines)
+        fr = run(read_framer, size, args.lines)
+        print(f"{size:>10}{mk:>20.0f}{fr:>18.0f}")
+
+    def framer_dropping(sock):
+        for frame in iter_frames(sock, LineFramer(), on_oversize=lambda e: None):
+            pass
+
+    mk_peak = oversized_line(read_makefile, args.oversize)
+    fr_peak = oversized_line(framer_dropping, args.oversize)
+    print(f"peak memory for a {args.oversize >> 20} MiB line: "
+          f"makefile {mk_peak / 1e6:.1f} MB, framer {fr_peak / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# in-process microbenchmarks for the request handlers in server.py. Clients
+# are real ClientInfo objects over socket.socketpair(); their writer threads
+# are not started, so only the handler itself (state updates, encoding and
+# queueing of frames) is timed, and queued output is thrown away every 100
+# calls. Each case reports ops/s, bytes still held after each call (mostly
+# queued frames) and the peak allocation of a single call, for a range of
+# group sizes and history lengths.
+#
+#     python3 bench/bench_handlers.py --save bench/baseline.json
+#     python3 bench/bench_handlers.py --compare bench/baseline.json
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+GROUP = "group1"
+GROUP_SIZES = (1, 10, 100)
+HISTORY_SIZES = (0, 1000, 10000)
+
+
+# the fixtures below are shared with the other in-process benches. srv is
+# the server module to run against, another server.py loaded from a file
+# for --baseline runs
+def reset(srv=server):
+    with srv.clients_lock:
+        for c in srv.clients:
+            c.sock.close()
+            c.peer.close()
+        srv.clients.clear()
+        srv.username_to_client.clear()
+        srv.detached_sessions.clear()
+        srv.detached_users.clear()
+    srv.init_groups()
+    srv.next_msg_id = 1
+    srv.queued_frames = 0
+
+
+def refresh(group, srv=server, **changed):
+    # servers from before the group snapshots have nothing to republish
+    if hasattr(srv, "refresh_snapshot"):
+        srv.refresh_snapshot(srv.groups[group], **changed)
+
+
+def make_client(name, group=GROUP, srv=server):
+    sock, peer = socket.socketpair()
+    c = srv.ClientInfo(sock, ("bench", name))
+    c.peer = peer
+    c.username = name
+    with srv.clients_lock:
+        srv.clients.add(c)
+        srv.username_to_client[name] = c
+    if group is not None:
+        srv.groups[group]["members"].add(name)
+        refresh(group, srv, messages=False)
+        c.groups.add(group)
+    return c
+
+
+# throws away what is queued for one client
+def discard(c, srv=server):
+    with c.out_cond:
+        n = c.pending
+        for lane in c.lanes:
+            lane.clear()
+        c.pending = 0
+    srv.frames_dequeued(n)
+
+
+def discard_output():
+    with server.clients_lock:
+        current = list(server.clients)
+    for c in current:
+        with c.out_cond:
+            for lane in c.lanes:
+                lane.clear()
+            c.pending = 0
+    server.queued_frames = 0
+
+
+def fill_history(n, group=GROUP, srv=server):
+    msgs = srv.groups[group]["messages"]
+    for _ in range(n):
+        msgs.append({
+            "id": srv.next_msg_id, "sender": "seed", "group": group,
+            "subject": "subject", "size": 100, "timestamp": "2024-01-01T00:00:00",
+        })
+        srv.bodies[srv.next_msg_id] = "x" * 100
+        srv.next_msg_id += 1
+    refresh(group, srv, members=False)
+
+
+def setup_group(members, history):
+    reset()
+    clients = [make_client(f"user{i}") for i in range(members)]
+    fill_history(history)
+    return clients
+
+
+# each case builds its state, then returns (op, undo): op(i) is timed, undo(i)
+# restores whatever op changed and is not
+def case_post(members, history):
+    clients = setup_group(members, history)
+    data = {"group": GROUP, "subject": "bench", "body": "y" * 100}
+    return (lambda i: server.handle_post(clients[0], data)), None
+
+
+def case_join(members, history):
+    clients = setup_group(members, history)
+    joiner = make_client("joiner", group=None)
+    data = {"group": GROUP}
+
+    def undo(i):
+        server.groups[GROUP]["members"].discard("joiner")
+        server.refresh_snapshot(server.groups[GROUP], messages=False)
+        joiner.groups.discard(GROUP)
+    return (lambda i: server.handle_join(joiner, data)), undo
+
+
+def case_get_message(members, history):
+    clients = setup_group(members, max(history, 1))
+    ids = [random.randint(1, server.next_msg_id - 1) for _ in range(1024)]
+    return (lambda i: server.handle_get_message(clients[0], {"group": GROUP, "id": ids[i & 1023]})), None
+
+
+def case_broadcast_event(members, history):
+    setup_group(members, history)
+    event = {"type": "event", "event": "new_message", "group": GROUP, "id": 1,
+             "sender": "user0", "subject": "bench", "date": "2024-01-01T00:00:00"}
+    return (lambda i: server.broadcast_event(GROUP, event)), None
+
+
+def case_disconnect_client(members, history):
+    setup_group(members, history)
+    state = {}
+
+    def prepare(i):
+        state["c"] = make_client(f"leaver{i}")
+
+    def op(i):
+        server.disconnect_client(state["c"])
+    # the victim has to exist before the timed call, so undo builds the next one
+    prepare(0)
+    return op, lambda i: (state["c"].peer.close(), prepare(i + 1))
+
+
+CASES = {
+    "post": (case_post, GROUP_SIZES, HISTORY_SIZES),
+    "join": (case_join, GROUP_SIZES, HISTORY_SIZES),
+    "get_message": (case_get_message, (1,), HISTORY_SIZES),
+    "broadcast_event": (case_broadcast_event, GROUP_SIZES, (0,)),
+    "disconnect_client": (case_disconnect_client, GROUP_SIZES, (0,)),
+}
+
+
+def run_case(factory, members, history, ops, rounds):
+    op, undo = factory(members, history)
+    best = None
+    # like timeit: no collector pauses inside the timed calls
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            elapsed = 0.0
+            for i in range(ops):
+                start = time.perf_counter()
+                op(i)
+                elapsed += time.perf_counter() - start
+                if undo:
+                    undo(i)
+                if i % 100 == 99:
+                    discard_output()
+            discard_output()
+            gc.collect()
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+
+    # allocations in a separate pass, tracing slows everything down
+    op, undo = factory(members, history)
+    n = max(1, ops // 10)
+    retained = 0
+    peak = 0
+    tracemalloc.start()
+    for i in range(n):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        op(i)
+        after, high = tracemalloc.get_traced_memory()
+        retained += after - before
+        peak = max(peak, high - before)
+        if undo:
+            undo(i)
+    tracemalloc.stop()
+    discard_output()
+    return {
+        "ops_per_sec": round(ops / best, 1) if best else None,
+        "bytes_per_op": round(retained / n, 1),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        if b is None:
+            continue
+        if r["ops_per_sec"] < b["ops_per_sec"] * (1 - tolerance):
+            failures.append(f"{key}: {r['ops_per_sec']:.0f} ops/s, baseline {b['ops_per_sec']:.0f}")
+        # small absolute slack, a few bytes/op of noise is not a regression
+        if r["bytes_per_op"] > b["bytes_per_op"] * (1 + tolerance) + 64:
+            failures.append(f"{key}: {r['bytes_per_op']:.0f} bytes/op, baseline {b['bytes_per_op']:.0f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="server.py handler microbenchmarks")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        help="comma separated subset of: " + ", ".join(CASES))
+    parser.add_argument("--ops", type=int, default=2000, help="calls per round")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds per case, the best is kept")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="fail if slower/bigger than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    server.settings["rate_limits"] = {}
+    results = {}
+    print(f"{'case':<42}{'ops/s':>12}{'bytes/op':>11}{'peak KiB':>10}", flush=True)
+    # disconnect_client prints a line per client
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name in args.cases.split(","):
+            factory, sizes, histories = CASES[name]
+            for members in sizes:
+                for history in histories:
+                    key = f"{name} members={members} history={history}"
+                    r = run_case(factory, members, history, args.ops, args.rounds)
+                    results[key] = r
+                    sys.__stdout__.write(f"{key:<42}{r['ops_per_sec']:>12.0f}"
+                                         f"{r['bytes_per_op']:>11.0f}{r['peak_kib']:>10.1f}\n")
+    reset()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f"baseline written to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        failures = compare(results, baseline, args.tolerance)
+        if failures:
+            print(f"{len(failures)} regressions against {args.compare}:")
+            for line in failures:
+                print("  " + line)
+            sys.exit(1)
+        print(f"no regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
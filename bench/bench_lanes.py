@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# measures how long a %users reply takes while the same client is being
+# flooded with new_message events, with priority lanes and with a single FIFO
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+
+def connect(port, username):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    f = s.makefile("r")
+    s.sendall((json.dumps({"action": "set_username", "username": username}) + "\n").encode())
+    s.sendall((json.dumps({"action": "join", "group": "public"}) + "\n").encode())
+    return s, f
+
+
+def flood(port, posts, stop, tag):
+    s, f = connect(port, "flooder-" + tag)
+    threading.Thread(target=lambda: [None for _ in f], daemon=True).start()
+    payload = b""
+    for i in range(100):
+        payload += (json.dumps({"action": "post", "group": "public",
+                                "subject": f"s{i}", "body": "x" * 200}) + "\n").encode()
+    sent = 0
+    while sent < posts and not stop.is_set():
+        s.sendall(payload)
+        sent += 100
+    s.close()
+
+
+def measure(port, samples, posts, tag):
+    s, f = connect(port, "observer-" + tag)
+    stop = threading.Event()
+    waiting = {}
+    latencies = []
+    got = threading.Event()
+
+    def reader():
+        for line in f:
+            obj = json.loads(line)
+            if obj.get("type") == "response" and obj.get("command") == "users" and "t" in waiting:
+                latencies.append(time.perf_counter() - waiting.pop("t"))
+                got.set()
+
+    threading.Thread(target=reader, daemon=True).start()
+    time.sleep(0.2)
+    t = threading.Thread(target=flood, args=(port, posts, stop, tag), daemon=True)
+    t.start()
+    time.sleep(0.1)
+    for _ in range(samples):
+        got.clear()
+        waiting["t"] = time.perf_counter()
+        s.sendall(b'{"action": "users", "group": "public"}\n')
+        if not got.wait(10):
+            break
+        time.sleep(0.01)
+    stop.set()
+    t.join()
+    s.close()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reply latency under broadcast load")
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--port", type=int, default=23460)
+    args = parser.parse_args()
+
+    # the flooder posts far faster than the per-connection limits allow
+    server.settings["rate_limits"] = {}
+    threading.Thread(target=server.run_server, args=(args.port,), daemon=True).start()
+    time.sleep(0.3)
+    results = {}
+    results["lanes"] = measure(args.port, args.samples, args.posts, "lanes")
+    time.sleep(0.5)
+    # single FIFO: everything goes through the reply lane in arrival order
+    server.lane_for = lambda obj: server.LANE_REPLY
+    results["fifo"] = measure(args.port, args.samples, args.posts, "fifo")
+    server.stop_server()
+
+    print(f"{'mode':<8}{'samples':>9}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for mode, lat in results.items():
+        if not lat:
+            print(f"{mode:<8}{0:>9}")
+            continue
+        lat = sorted(x * 1000 for x in lat)
+        p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+        print(f"{mode:<8}{len(lat):>9}{statistics.median(lat):>10.2f}{p95:>10.2f}{lat[-1]:>10.2f}")
+    with server.stats_lock:
+        for name, ls in zip(server.LANE_NAMES, server.lane_stats):
+            avg = 1000 * ls["wait_total"] / ls["frames"] if ls["frames"] else 0.0
+            print(f"lane {name:<9} frames={ls['frames']:<8} avg_wait_ms={avg:.3f} "
+                  f"max_wait_ms={1000 * ls['wait_max']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# connect and shutdown costs with many clients. Opens --clients connections
+# (each logs in and joins one of the groups), timing connect -> welcome, then
+# sends a shutdown and times how long the server process takes to exit.
+# --server runs another copy of server.py, e.g. an older one to compare with.
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUPS = ["group1", "group2", "group3", "group4", "group5"]
+
+
+def read_line(sock, buf):
+    while b"\n" not in buf:
+        data = sock.recv(1 << 16)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buf += data
+    line, _, rest = buf.partition(b"\n")
+    return json.loads(line), rest
+
+
+def open_clients(port, n):
+    socks = []
+    welcome = []
+    for i in range(n):
+        start = time.perf_counter()
+        s = socket.create_connection(("127.0.0.1", port))
+        first, _ = read_line(s, b"")
+        welcome.append(time.perf_counter() - start)
+        if first.get("type") == "error":
+            s.close()
+            return socks, welcome, first
+        # replies and presence events are left unread, they fit in the socket buffers
+        s.sendall((json.dumps({"action": "set_username", "username": f"u{i}"}) + "\n"
+                   + json.dumps({"action": "join", "group": GROUPS[i % len(GROUPS)]}) + "\n").encode())
+        socks.append(s)
+    return socks, welcome, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="connect latency and shutdown time with many clients")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=23490)
+    parser.add_argument("--server", default=os.path.join(ROOT, "server.py"),
+                        help="server.py to run (default: this checkout)")
+    parser.add_argument("--server-args", default="", help="extra arguments for the server, space separated")
+    args = parser.parse_args()
+
+    cmd = [sys.executable, args.server, str(args.port), "--no-rate-limits"] + args.server_args.split()
+    srv = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", args.port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        start = time.perf_counter()
+        socks, welcome, refused = open_clients(args.port, args.clients)
+        setup = time.perf_counter() - start
+        if refused:
+            # make room for the control connection
+            socks.pop().close()
+        # let the server finish the logins and joins before timing the shutdown
+        while True:
+            ctl = socket.create_connection(("127.0.0.1", args.port))
+            first, buf = read_line(ctl, b"")
+            if first.get("type") != "error":
+                break
+            # the freed slot is not seen by the server yet
+            ctl.close()
+            time.sleep(0.1)
+        ctl.sendall(b'{"action": "set_username", "username": "ctl"}\n{"action": "stats"}\n')
+        while True:
+            obj, buf = read_line(ctl, buf)
+            if obj.get("command") == "stats":
+                break
+        start = time.perf_counter()
+        ctl.sendall(b'{"action": "shutdown"}\n')
+        srv.wait(120)
+        shutdown = time.perf_counter() - start
+    finally:
+        if srv.poll() is None:
+            srv.kill()
+            srv.wait()
+
+    welcome.sort()
+    print(f"{len(socks)} clients connected in {setup:.2f}s"
+          + (f", refused after that: {refused.get('code')}" if refused else ""))
+    print(f"connect -> welcome: p50 {statistics.median(welcome) * 1000:.2f} ms, "
+          f"p99 {welcome[int(len(welcome) * 0.99)] * 1000:.2f} ms, max {welcome[-1] * 1000:.2f} ms")
+    print(f"shutdown request -> server exit: {shutdown:.2f}s")
+    for s in socks:
+        s.close()
+
+
+if __name__ == "__main__":
+    main()
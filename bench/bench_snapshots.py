@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# read/write mix against the handlers in server.py: reader threads call
+# users, get_message (recent ids) and sync while writer threads post to the
+# same group, for a fixed time per mix. Clients come from the fixtures in
+# bench_handlers.py; every thread throws away its own queued output as it goes, and yields the GIL after every request the
+# way a server thread does when it goes back to recv() (--busy: never yield,
+# all threads CPU bound). Also reports how much memory the group snapshots
+# take. --baseline loads another server.py (e.g. from an older
+# checkout) and runs the same mixes against it first.
+#
+#     git show HEAD~1:server.py > /tmp/server_old.py
+#     python3 bench/bench_snapshots.py --baseline /tmp/server_old.py
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import server
+from bench_handlers import discard, fill_history, make_client, reset
+
+GROUP = "group1"
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("server_baseline", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def setup(srv, members, history):
+    srv.settings["rate_limits"] = {}
+    reset(srv)
+    clients = [make_client(f"user{i}", srv=srv) for i in range(members)]
+    fill_history(history, srv=srv)
+    return clients
+
+
+def reader(srv, client, stop, counts, idx, pause):
+    rnd = random.Random(idx)
+    n = 0
+    while not stop.is_set():
+        newest = srv.next_msg_id - 1
+        op = n % 3
+        if op == 0:
+            srv.handle_users(client, {"group": GROUP})
+        elif op == 1:
+            srv.handle_get_message(client, {"group": GROUP, "id": newest - rnd.randrange(100)})
+        else:
+            srv.handle_sync(client, {"group": GROUP, "since": newest - 5})
+        n += 1
+        pause()
+        if n % 100 == 0:
+            discard(client, srv)
+    counts[idx] = n
+
+
+def writer(srv, client, stop, counts, idx, pause):
+    data = {"group": GROUP, "subject": "bench", "body": "y" * 100}
+    n = 0
+    while not stop.is_set():
+        srv.handle_post(client, data)
+        n += 1
+        pause()
+        if n % 100 == 0:
+            discard(client, srv)
+    counts[idx] = n
+
+
+def run_mix(srv, readers, writers, seconds, history, busy):
+    clients = setup(srv, readers + writers, history)
+    # time.sleep(0) releases the GIL like the recv() between two requests
+    pause = (lambda: None) if busy else (lambda: time.sleep(0))
+    stop = threading.Event()
+    counts = [0] * (readers + writers)
+    threads = []
+    for i, c in enumerate(clients):
+        target = reader if i < readers else writer
+        threads.append(threading.Thread(target=target, args=(srv, c, stop, counts, i, pause), daemon=True))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    result = {
+        "reads_per_s": sum(counts[:readers]) / seconds,
+        "writes_per_s": sum(counts[readers:]) / seconds,
+        "lock_wait_ms": srv.state_lock.avg_wait * 1000,
+    }
+    reset(srv)
+    return result
+
+
+def snapshot_bytes(srv):
+    total = 0
+    for gdata in srv.groups.values():
+        snap = gdata["snap"]
+        # the message dicts are shared with the full list, only the tuples
+        # and the member set are extra
+        total += (sys.getsizeof(snap) + sys.getsizeof(snap.members)
+                  + sys.getsizeof(snap.users) + sys.getsizeof(snap.recent))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="read/write mix with and without group snapshots")
+    parser.add_argument("--mixes", default="8:1,4:4,1:4",
+                        help="comma separated readers:writers thread counts")
+    parser.add_argument("--seconds", type=float, default=3.0, help="run time per mix")
+    parser.add_argument("--history", type=int, default=1000, help="messages in the group before the run")
+    parser.add_argument("--baseline", metavar="SERVER_PY", help="also run against this server.py")
+    parser.add_argument("--busy", action="store_true",
+                        help="threads never yield between requests (pipelined, CPU bound clients)")
+    args = parser.parse_args()
+
+    mixes = [tuple(int(x) for x in m.split(":")) for m in args.mixes.split(",")]
+    targets = []
+    if args.baseline:
+        targets.append(("baseline", load_module(args.baseline)))
+    targets.append(("snapshots", server))
+
+    print(f"{'server':<11}{'readers:writers':>16}{'reads/s':>11}{'writes/s':>10}{'lock wait ms':>14}")
+    results = {}
+    for name, srv in targets:
+        for readers, writers in mixes:
+            r = run_mix(srv, readers, writers, args.seconds, args.history, args.busy)
+            results[(name, readers, writers)] = r
+            print(f"{name:<11}{f'{readers}:{writers}':>16}{r['reads_per_s']:>11.0f}"
+                  f"{r['writes_per_s']:>10.0f}{r['lock_wait_ms']:>14.3f}", flush=True)
+    if args.baseline:
+        for readers, writers in mixes:
+            b = results[("baseline", readers, writers)]
+            s = results[("snapshots", readers, writers)]
+            print(f"{readers}:{writers}  reads x{s['reads_per_s'] / max(b['reads_per_s'], 1):.2f}"
+                  f"  writes x{s['writes_per_s'] / max(b['writes_per_s'], 1):.2f}")
+
+    # memory held by snapshots with a full window in every group
+    setup(server, 100, server.settings["snapshot_window"])
+    for g in server.groups.values():
+        g["messages"][:] = server.groups[GROUP]["messages"]
+        g["members"].update(server.groups[GROUP]["members"])
+        server.refresh_snapshot(g)
+    print(f"snapshots: {snapshot_bytes(server) / 1024:.1f} KiB for {len(server.groups)} groups "
+          f"of 100 members with {server.settings['snapshot_window']}-message windows")
+    reset()
+
+
+if __name__ == "__main__":
+    main()
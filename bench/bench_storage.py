@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# tiered message storage: posts a few hundred MB of messages through
+# handle_post with a memory budget and with spilling turned off, then times
+# get_message on hot (recent) and cold (spilled) ids. Reports post rate,
+# read latency per tier and the store's spill/load counters, then fills
+# again under tracemalloc (which slows everything down) for the Python heap
+# held by the messages. Handlers are called in-process, with the client
+# fixtures from bench_handlers.py.
+import argparse
+import gc
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+from bench_handlers import discard, make_client, reset as reset_server
+
+GROUP = "group1"
+
+
+def fill(c, count, body_size):
+    filler = "x" * body_size
+    start = time.perf_counter()
+    for i in range(count):
+        # a body of its own for every message, like bodies parsed off the wire
+        body = f"{i:09d}" + filler[9:]
+        server.handle_post(c, {"group": GROUP, "subject": "bench", "body": body})
+        if i % 100 == 99:
+            discard(c)
+    discard(c)
+    return count / (time.perf_counter() - start)
+
+
+def read_latency(c, ids, reads):
+    times = []
+    for _ in range(reads):
+        msg_id = random.choice(ids)
+        start = time.perf_counter()
+        server.handle_get_message(c, {"group": GROUP, "id": msg_id})
+        times.append(time.perf_counter() - start)
+        discard(c)
+    times.sort()
+    return statistics.median(times) * 1e6, times[int(len(times) * 0.99)] * 1e6
+
+
+def reset(budget):
+    server.settings["memory_budget"] = budget
+    reset_server()
+    return make_client("bench")
+
+
+def heap_held(budget, count, body_size):
+    c = reset(budget)
+    gc.collect()
+    tracemalloc.start()
+    fill(c, count, body_size)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    reset_server()
+    return held
+
+
+def run(budget, count, body_size, reads):
+    c = reset(budget)
+    posts_per_s = fill(c, count, body_size)
+    gdata = server.groups[GROUP]
+    hot_ids = [m["id"] for m in gdata["messages"]]
+    # the oldest ids, spilled when there is a budget
+    old_ids = list(range(1, min(count, 1000) + 1))
+    result = {
+        "posts_per_s": posts_per_s,
+        "hot": read_latency(c, hot_ids[-1000:], reads),
+        "old": read_latency(c, old_ids, reads),
+        "hot_messages": len(gdata["messages"]),
+        "cold_messages": gdata["spilled"],
+        "store": server.store.stats() if server.store is not None else {},
+    }
+    result["heap_mib"] = heap_held(budget, count, body_size) / (1 << 20)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hot/cold message tiers under a memory budget")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--body", type=int, default=4000, help="body size in bytes")
+    parser.add_argument("--budget", type=float, default=32, help="memory budget in MiB")
+    parser.add_argument("--reads", type=int, default=5000, help="get_message calls per tier")
+    args = parser.parse_args()
+
+    random.seed(0)
+    server.settings["rate_limits"] = {}
+    print(f"{args.messages} messages of {args.body} bytes "
+          f"({args.messages * args.body / (1 << 20):.0f} MiB of bodies)")
+    print(f"{'budget':<12}{'posts/s':>9}{'heap MiB':>10}{'hot':>7}{'cold':>7}"
+          f"{'hot get p50/p99 us':>21}{'old get p50/p99 us':>21}")
+    results = {}
+    for name, budget in (("none", 0), (f"{args.budget:g} MiB", int(args.budget * (1 << 20)))):
+        r = results[name] = run(budget, args.messages, args.body, args.reads)
+        print(f"{name:<12}{r['posts_per_s']:>9.0f}{r['heap_mib']:>10.1f}{r['hot_messages']:>7}"
+              f"{r['cold_messages']:>7}{'%.1f / %.1f' % r['hot']:>21}{'%.1f / %.1f' % r['old']:>21}",
+              flush=True)
+    for key, value in results[f"{args.budget:g} MiB"]["store"].items():
+        print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
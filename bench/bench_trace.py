@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# end-to-end latency of post -> new_message delivery, split into stages.
+# Starts a server with --trace-file, posts traced messages from one client to
+# a group of receivers and joins the client timestamps with the server's
+# trace records by trace id. Everything runs on one host, so client and
+# server share time.monotonic_ns().
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bbclient import BulletinClient
+
+GROUP = "group1"
+
+
+def pct(values, p):
+    v = sorted(values)
+    return v[min(len(v) - 1, int(p * len(v)))]
+
+
+async def receive(client, received):
+    async for obj in client:
+        if obj.get("event") == "new_message" and "trace" in obj:
+            received.append((obj["trace"], client.username, obj["received_ns"]))
+
+
+async def run(port, receivers, posts, rate, body):
+    sender = BulletinClient()
+    await sender.connect("127.0.0.1", port)
+    await sender.set_username("sender")
+    await sender.join(GROUP)
+    received = []
+    clients = []
+    tasks = []
+    for i in range(receivers):
+        c = BulletinClient(trace_ack=True)
+        await c.connect("127.0.0.1", port)
+        await c.set_username(f"receiver{i}")
+        await c.join(GROUP)
+        clients.append(c)
+        tasks.append(asyncio.ensure_future(receive(c, received)))
+
+    sent = {}
+    for i in range(posts):
+        t = time.monotonic_ns()
+        frames = await sender.request("post", group=GROUP, subject=f"s{i}", body=body, trace=True)
+        sent[frames[-1]["trace"]] = t
+        if rate:
+            await asyncio.sleep(1.0 / rate)
+    # let the last deliveries and their acks arrive
+    deadline = time.monotonic() + 5
+    while len(received) < posts * receivers and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+
+    await sender.shutdown()
+    for c in clients + [sender]:
+        await c.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return sent, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description="post -> delivery latency by stage")
+    parser.add_argument("--receivers", type=int, default=20)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200.0, help="posts per second, 0 = back to back")
+    parser.add_argument("--body", type=int, default=200, help="body size in bytes")
+    parser.add_argument("--port", type=int, default=23470)
+    args = parser.parse_args()
+
+    trace_path = os.path.join(tempfile.mkdtemp(), "traces.jsonl")
+    srv = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(args.port),
+                            "--trace-file", trace_path, "--trace-sample", "0", "--no-rate-limits"],
+                           stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+    try:
+        sent, received = asyncio.run(run(args.port, args.receivers, args.posts, args.rate, "x" * args.body))
+    finally:
+        srv.wait(10)
+
+    traces, acks = {}, {}
+    with open(trace_path, encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if "ack" in rec:
+                acks[(rec["trace"], rec["ack"])] = rec["t_ns"]
+            else:
+                traces[rec["trace"]] = rec
+
+    segments = {name: [] for name in (
+        "client -> read", "read -> parsed", "parsed -> locked", "locked -> stored",
+        "stored -> fanout", "fanout -> sent", "sent -> received", "end to end", "read -> ack")}
+    for tid, t_send in sent.items():
+        rec = traces.get(tid)
+        if rec is None:
+            continue
+        st = rec["stages_us"]
+        t_read = rec["t_read_ns"]
+        segments["client -> read"].append((t_read - t_send) / 1000)
+        segments["read -> parsed"].append(st["parsed"])
+        segments["parsed -> locked"].append(st["locked"] - st["parsed"])
+        segments["locked -> stored"].append(st["stored"] - st["locked"])
+        segments["stored -> fanout"].append(st["fanout"] - st["stored"])
+        sends = {s["user"]: s["us"] for s in rec["sends"] if s["us"] is not None}
+        for user, us in sends.items():
+            segments["fanout -> sent"].append(us - st["fanout"])
+            ack = acks.get((tid, user))
+            if ack is not None:
+                segments["read -> ack"].append((ack - t_read) / 1000)
+    for tid, user, t_recv in received:
+        rec = traces.get(tid)
+        if rec is None or tid not in sent:
+            continue
+        sends = {s["user"]: s["us"] for s in rec["sends"] if s["us"] is not None}
+        if user in sends:
+            segments["sent -> received"].append((t_recv - rec["t_read_ns"]) / 1000 - sends[user])
+        segments["end to end"].append((t_recv - sent[tid]) / 1000)
+
+    print(f"{args.posts} posts to {args.receivers} receivers, {len(traces)} traced, "
+          f"{len(received)} deliveries, {len(acks)} acks")
+    print(f"{'stage':<20}{'n':>8}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}{'max us':>10}")
+    for name, vals in segments.items():
+        if not vals:
+            print(f"{name:<20}{0:>8}")
+            continue
+        print(f"{name:<20}{len(vals):>8}{pct(vals, 0.5):>10.0f}{pct(vals, 0.9):>10.0f}"
+              f"{pct(vals, 0.99):>10.0f}{max(vals):>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# round trip latency and throughput of the same server over loopback TCP and
+# over its Unix domain socket (server.py --unix): ping/pong round trips one at
+# a time, a pipelined burst of small posts, and repeated 60 KB get_message
+# replies for bulk transfer
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from framing import LineFramer, iter_frames
+
+
+class Conn:
+    def __init__(self, family, address, username):
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.frames = iter_frames(self.sock, LineFramer(4 << 20))
+        self.next_frame()   # welcome
+        self.call({"action": "set_username", "username": username}, "groups")
+        self.call({"action": "join", "group": "group1"}, "users")
+
+    def next_frame(self):
+        return json.loads(next(self.frames))
+
+    def send(self, obj):
+        self.sock.sendall((json.dumps(obj) + "\n").encode("utf-8"))
+
+    # sends one request and reads until the reply that ends it
+    def call(self, obj, final):
+        self.send(obj)
+        while True:
+            f = self.next_frame()
+            if f.get("type") == final or f.get("command") == final:
+                return f
+
+    def close(self):
+        self.send({"action": "exit"})
+        self.sock.close()
+
+
+def bench(family, address, tag, args):
+    c = Conn(family, address, f"bench-{tag}")
+    for _ in range(100):
+        c.call({"action": "ping"}, "pong")
+    rtts = []
+    for _ in range(args.pings):
+        start = time.perf_counter()
+        c.call({"action": "ping"}, "pong")
+        rtts.append(time.perf_counter() - start)
+
+    # pipelined posts, one sendall for the whole burst
+    burst = "".join(json.dumps({"action": "post", "group": "group1", "subject": f"s{i}",
+                                "body": "x" * 100}) + "\n" for i in range(args.posts)).encode()
+    start = time.perf_counter()
+    c.sock.sendall(burst)
+    got = 0
+    while got < args.posts:
+        if c.next_frame().get("command") == "post":
+            got += 1
+    posts_per_s = args.posts / (time.perf_counter() - start)
+
+    big = c.call({"action": "post", "group": "group1", "subject": "big",
+                  "body": "y" * args.body}, "post")["id"]
+    request = (json.dumps({"action": "get_message", "group": "group1", "id": big}) + "\n").encode()
+    start = time.perf_counter()
+    c.sock.sendall(request * args.fetches)
+    for _ in range(args.fetches):
+        while c.next_frame().get("command") != "message":
+            pass
+    elapsed = time.perf_counter() - start
+    c.close()
+    return {
+        "rtt_p50_us": statistics.median(rtts) * 1e6,
+        "rtt_p99_us": sorted(rtts)[int(len(rtts) * 0.99)] * 1e6,
+        "posts_per_s": posts_per_s,
+        "fetch_mb_per_s": args.fetches * args.body / elapsed / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="loopback TCP vs Unix domain socket")
+    parser.add_argument("--port", type=int, default=23480)
+    parser.add_argument("--pings", type=int, default=5000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--fetches", type=int, default=2000)
+    parser.add_argument("--body", type=int, default=60000, help="body size for the fetch test")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bb.sock")
+    srv = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(args.port),
+                            "--unix", path, "--no-rate-limits"], stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        results = {
+            "tcp": bench(socket.AF_INET, ("127.0.0.1", args.port), "tcp", args),
+            "unix": bench(socket.AF_UNIX, path, "unix", args),
+        }
+    finally:
+        srv.terminate()
+        srv.wait(10)
+
+    print(f"{'transport':<10}{'rtt p50 us':>12}{'rtt p99 us':>12}{'posts/s':>12}{'fetch MB/s':>12}")
+    for name, r in results.items():
+        print(f"{name:<10}{r['rtt_p50_us']:>12.1f}{r['rtt_p99_us']:>12.1f}"
+              f"{r['posts_per_s']:>12.0f}{r['fetch_mb_per_s']:>12.1f}")
+    tcp, unix = results["tcp"], results["unix"]
+    print(f"unix vs tcp: rtt {tcp['rtt_p50_us'] / unix['rtt_p50_us']:.2f}x, "
+          f"posts {unix['posts_per_s'] / tcp['posts_per_s']:.2f}x, "
+          f"fetch {unix['fetch_mb_per_s'] / tcp['fetch_mb_per_s']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
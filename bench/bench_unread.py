@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# cost of read cursors: times handle_unread for a member of every group as
+# the groups' history grows, next to counting the unread messages by
+# scanning each group's list (what answering without cursors would take),
+# and handle_post with --members members holding cursors in the group.
+# Handlers are called in-process, with the client fixtures from
+# bench_handlers.py.
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+from bench_handlers import discard, fill_history, make_client, reset
+
+GROUP = "group1"
+
+
+def setup(members, history):
+    server.settings["rate_limits"] = {}
+    server.settings["memory_budget"] = 0
+    reset()
+    clients = [make_client(f"user{i}", group=None) for i in range(members)]
+    for c in clients:
+        for g in server.groups:
+            server.join_group(c, g, None)
+        discard(c)
+    # history the readers have not seen, in every group
+    for g in server.groups:
+        fill_history(history, g)
+    return clients
+
+
+def timed(fn, reps):
+    times = []
+    for _ in range(reps):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e6
+
+
+def scan_unread(c):
+    with server.state_lock:
+        return {g: sum(1 for m in server.groups[g]["messages"]
+                       if m["id"] > server.groups[g]["cursors"][c.username].last)
+                for g in c.groups}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="unread counts from read cursors vs scanning")
+    parser.add_argument("--history", default="100,10000,100000", help="comma separated messages per group")
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--reps", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'history/group':<15}{'unread us':>11}{'scan us':>11}{'post us':>10}")
+    for history in (int(h) for h in args.history.split(",")):
+        clients = setup(args.members, history)
+        reader, poster = clients[0], clients[1]
+
+        def unread():
+            server.handle_unread(reader, {})
+            discard(reader)
+
+        def post():
+            server.handle_post(poster, {"group": GROUP, "subject": "bench", "body": "y" * 100})
+            for c in clients:
+                discard(c)
+
+        unread_us = timed(unread, args.reps)
+        scan_us = timed(lambda: scan_unread(reader), max(1, args.reps // 10))
+        post_us = timed(post, args.reps)
+        print(f"{history:<15}{unread_us:>11.1f}{scan_us:>11.1f}{post_us:>10.1f}", flush=True)
+        reset()
+
+
+if __name__ == "__main__":
+    main()
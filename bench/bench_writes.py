@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# compares one sendall per event (the old send path) with the coalesced
+# sendmsg writer in server.py for a burst of new_message events in a busy group
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+
+def tcp_pair():
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(("127.0.0.1", 0))
+    lsock.listen()
+    a = socket.create_connection(lsock.getsockname())
+    b, _ = lsock.accept()
+    lsock.close()
+    b.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return b, a
+
+
+def drain(sock, expected, done):
+    got = 0
+    while got < expected:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            break
+        got += len(chunk)
+    done.set()
+
+
+def make_event(i):
+    return {
+        "type": "event",
+        "event": "new_message",
+        "group": "public",
+        "id": i,
+        "sender": "poster",
+        "subject": f"subject {i}",
+        "date": "2024-01-01T00:00:00"
+    }
+
+
+def run_legacy(members, events):
+    pairs = [tcp_pair() for _ in range(members)]
+    locks = [threading.Lock() for _ in pairs]
+    frames = [(json.dumps(make_event(i)) + "\n").encode("utf-8") for i in range(events)]
+    total = sum(len(f) for f in frames)
+    waiters = []
+    for _, peer in pairs:
+        done = threading.Event()
+        threading.Thread(target=drain, args=(peer, total, done), daemon=True).start()
+        waiters.append(done)
+    start = time.perf_counter()
+    for i in range(events):
+        event = make_event(i)
+        # encoded per receiver under its send lock, as the old send_json did
+        for (srv, _), lock in zip(pairs, locks):
+            data = (json.dumps(event) + "\n").encode("utf-8")
+            with lock:
+                srv.sendall(data)
+    for w in waiters:
+        w.wait()
+    elapsed = time.perf_counter() - start
+    for a, b in pairs:
+        a.close()
+        b.close()
+    return elapsed, events * members
+
+
+def run_coalesced(members, events):
+    server.init_groups()
+    pairs = [tcp_pair() for _ in range(members)]
+    total = sum(len((json.dumps(make_event(i)) + "\n").encode("utf-8")) for i in range(events))
+    clients = []
+    waiters = []
+    for n, (srv, peer) in enumerate(pairs):
+        c = server.ClientInfo(srv, ("bench", n))
+        c.username = f"user{n}"
+        server.username_to_client[c.username] = c
+        server.groups["public"]["members"].add(c.username)
+        server.start_writer(c)
+        clients.append(c)
+        done = threading.Event()
+        threading.Thread(target=drain, args=(peer, total, done), daemon=True).start()
+        waiters.append(done)
+    # fan-out reads the member set from the group snapshot
+    server.refresh_snapshot(server.groups["public"], messages=False)
+    with server.stats_lock:
+        before = server.stats["send_syscalls"]
+    start = time.perf_counter()
+    for i in range(events):
+        server.broadcast_event("public", make_event(i))
+    for w in waiters:
+        w.wait()
+    elapsed = time.perf_counter() - start
+    with server.stats_lock:
+        syscalls = server.stats["send_syscalls"] - before
+    for c in clients:
+        server.disconnect_client(c)
+    for _, peer in pairs:
+        peer.close()
+    return elapsed, syscalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sendall vs coalesced sendmsg")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--flush-delay", type=float, default=server.settings["flush_delay"])
+    args = parser.parse_args()
+    server.settings["flush_delay"] = args.flush_delay
+
+    frames = args.members * args.events
+    legacy_time, legacy_calls = run_legacy(args.members, args.events)
+    co_time, co_calls = run_coalesced(args.members, args.events)
+
+    print(f"{args.members} members x {args.events} events = {frames} frames")
+    print(f"{'path':<12}{'syscalls':>12}{'frames/s':>14}{'seconds':>10}")
+    print(f"{'sendall':<12}{legacy_calls:>12}{frames / legacy_time:>14.0f}{legacy_time:>10.3f}")
+    print(f"{'sendmsg':<12}{co_calls:>12}{frames / co_time:>14.0f}{co_time:>10.3f}")
+    print(f"syscalls: {legacy_calls / max(co_calls, 1):.1f}x fewer, "
+          f"throughput: {legacy_time / co_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
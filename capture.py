@@ -0,0 +1,63 @@
+# traffic capture log written by `server.py --capture` and read by replay.py.
+#
+# The file starts with MAGIC, followed by records of
+#     kind u8 | conn u32 | seq u32 | t_us u64 | length u32 | data
+# little endian. t_us is microseconds since the capture started. For IN
+# records seq numbers the connection's frames from 1; OUT records carry the
+# seq of the request they answer (0 for the welcome) and are written when
+# the frame has gone out on the socket.
+import struct
+import threading
+import time
+
+MAGIC = b"BBCAP1\n"
+HEADER = struct.Struct("<BIIQI")
+
+OPEN = 1    # connection accepted, data is the peer address
+IN = 2      # one request line as received, without the newline
+OUT = 3     # one reply-lane frame sent back, without the newline
+CLOSE = 4   # connection gone
+
+KIND_NAMES = {OPEN: "open", IN: "in", OUT: "out", CLOSE: "close"}
+
+
+class CaptureWriter:
+    def __init__(self, path, buffer_size=1 << 16):
+        self.path = path
+        self.f = open(path, "wb", buffering=buffer_size)
+        self.f.write(MAGIC)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.records = 0
+
+    def record(self, kind, conn, seq, data=b""):
+        t_us = int((time.monotonic() - self.start) * 1e6)
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write(HEADER.pack(kind, conn, seq, t_us, len(data)))
+            self.f.write(data)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+# yields (kind, conn, seq, seconds, data); a record cut short at the end of
+# the file (server killed mid-write) is ignored
+def read_capture(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return
+            kind, conn, seq, t_us, length = HEADER.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, conn, seq, t_us / 1e6, data
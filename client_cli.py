@@ -1,33 +1,42 @@
 #!/usr/bin/env python3
-import socket
+import asyncio
+import argparse
 import json
-import threading
 import sys
+import threading
+import time
 
-sock = None
-sock_file = None
-receiver_thread = None
-connected = False
+from bbclient import (BulletinClient, ServerError, ConnectionClosed, PUBLIC_GROUP,
+                      DEFAULT_PORT, unix_path)
+from msgcache import MessageCache
+
+# the protocol runs on an asyncio loop in a background thread (see bbclient),
+# the prompt stays on the main thread
+loop = None
+client = None
 current_username = None
-lock = threading.Lock()
+# messages seen so far, kept across reconnects (and runs, with --cache)
+cache = MessageCache()
+auto_reconnect = False
+# group -> unread count, from the last unread/ack reply plus new posts since
+unread_counts = {}
 
-def send_obj(obj):
-    global sock
-    if not sock:
-        print("Not connected.")
-        return
-    data = (json.dumps(obj) + "\n").encode("utf-8")
-    with lock:
-        sock.sendall(data)
+def start_loop():
+    global loop
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+def run(coro):
+    # run a coroutine on the client loop and wait for its result
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+def is_connected():
+    return client is not None and not client.closed
 
 def handle_server_message(obj):
     t = obj.get("type")
     if t == "info":
-        msg = obj.get("message", "")
-        subtype = obj.get("subtype")
-        print(f"[INFO] {msg}")
-        if subtype == "username_accepted":
-            global current_username
+        print(f"[INFO] {obj.get('message', '')}")
     elif t == "error":
         print(f"[ERROR] {obj.get('message','')}")
     elif t == "event":
@@ -37,9 +46,19 @@ def handle_server_message(obj):
         elif ev == "user_left":
             print(f"[EVENT] {obj.get('user')} left group {obj.get('group')}")
         elif ev == "new_message":
+            if obj.get("group") in unread_counts and obj.get("sender") != current_username:
+                unread_counts[obj.get("group")] += 1
             print(f"[NEW MESSAGE] ({obj.get('group')}) "
                   f"ID={obj.get('id')} From={obj.get('sender')} "
                   f"Date={obj.get('date')} Subject={obj.get('subject')}")
+        elif ev == "digest":
+            if obj.get("group") in unread_counts:
+                unread_counts[obj.get("group")] += sum(
+                    1 for m in obj.get("messages", []) if m.get("sender") != current_username)
+            print(f"[DIGEST] ({obj.get('group')}) {obj.get('count')} new messages")
+            for m in obj.get("messages", []):
+                print(f"  ID={m.get('id')} From={m.get('sender')} "
+                      f"Date={m.get('date')} Subject={m.get('subject')}")
         else:
             print(f"[EVENT] {obj}")
     elif t == "response":
@@ -47,15 +66,40 @@ def handle_server_message(obj):
         if cmd == "groups":
             print("[GROUPS] Available groups:")
             for g in obj.get("groups", []):
-                print(f"  - {g}")
+                print(f"  - {g}{badge(g)}")
         elif cmd == "users":
             group = obj.get("group")
             users = obj.get("users", [])
             print(f"[USERS in {group}] {', '.join(users) if users else '(none)'}")
+        elif cmd == "post":
+            print(f"[POSTED] Message {obj.get('id')} to {obj.get('group')}")
+        elif cmd == "leave":
+            unread_counts.pop(obj.get("group"), None)
+            print(f"[LEFT] {obj.get('group')}")
+        elif cmd == "ack":
+            unread_counts[obj.get("group")] = obj.get("unread", 0)
+            print(f"[READ] {obj.get('group')} up to {obj.get('id')}{badge(obj.get('group'))}")
+        elif cmd == "unread":
+            unread_counts.clear()
+            print("[UNREAD]")
+            for g, u in obj.get("groups", {}).items():
+                unread_counts[g] = u.get("unread", 0)
+                first = f", first ID={u['first_unread']}" if u.get("first_unread") else ""
+                print(f"  {g}: {u.get('unread', 0)}{first}")
+        elif cmd == "stats":
+            print("[STATS]")
+            for k, v in sorted(obj.get("stats", {}).items()):
+                if isinstance(v, dict):
+                    print(f"  {k}:")
+                    for sub, val in v.items():
+                        print(f"    {sub}: {val}")
+                else:
+                    print(f"  {k}: {v}")
         elif cmd == "message":
             group = obj.get("group")
             m = obj.get("message", {})
-            print(f"[MESSAGE {m.get('id')} in {group}]")
+            cached = " (cached)" if obj.get("cached") else ""
+            print(f"[MESSAGE {m.get('id')} in {group}]{cached}")
             print(f" From: {m.get('sender')}")
             print(f" Date: {m.get('timestamp')}")
             print(f" Subject: {m.get('subject')}")
@@ -70,125 +114,328 @@ def handle_server_message(obj):
         for m in msgs:
             print(f"  ID={m.get('id')} From={m.get('sender')} "
                   f"Date={m.get('timestamp')} Subject={m.get('subject')}")
+        if obj.get("more"):
+            print("  (more messages missed, the next ones follow)")
     else:
         print(f"[SERVER] {obj}")
 
-def receiver_loop():
-    global sock_file, connected
+# " (3 unread)" after a group name, empty when there is nothing to read
+def badge(group):
+    n = unread_counts.get(group)
+    return f" ({n} unread)" if n else ""
+
+def print_reply(fut):
     try:
-        for line in sock_file:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-                handle_server_message(obj)
-            except json.JSONDecodeError:
-                print("[CLIENT] Invalid JSON from server:", line)
+        frames = fut.result()
+    except ServerError as e:
+        handle_server_message(e.reply)
+        return
+    except ConnectionClosed:
+        print("Not connected.")
+        return
     except Exception as e:
-        if connected:
-            print("[CLIENT] Connection error:", e)
-    finally:
-        connected = False
-        print("[CLIENT] Disconnected from server.")
+        print("[CLIENT] Request failed:", e)
+        return
+    for obj in frames:
+        handle_server_message(obj)
+
+def send_cmd(action, **fields):
+    # fire the request without blocking the prompt, print the reply when it lands
+    if not is_connected():
+        print("Not connected.")
+        return
+    fut = asyncio.run_coroutine_threadsafe(client.request(action, **fields), loop)
+    fut.add_done_callback(print_reply)
+
+async def pump_events(events):
+    async for obj in events:
+        handle_server_message(obj)
+    print("[CLIENT] Disconnected from server.")
 
 def connect_cmd(host, port):
-    global sock, sock_file, receiver_thread, connected, current_username
-    if connected:
+    global client, current_username
+    if is_connected():
         print("Already connected. Use %exit to disconnect first.")
         return
 
-    # socket connecting
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((host, port))
-    f = s.makefile("r")
-    sock = s
-    sock_file = f
-    connected = True
-    print(f"Connected to {host}:{port}")
+    c = BulletinClient(cache=cache, auto_reconnect=auto_reconnect)
+    try:
+        run(c.connect(host, port))
+    except OSError as e:
+        print("[CLIENT] Cannot connect:", e)
+        return
+    client = c
+    print(f"Connected to {host}" if unix_path(host) else f"Connected to {host}:{port}")
 
+    # show the welcome before prompting, then keep printing events in the background
+    events = c.events()
     try:
-        first = f.readline()
-        if first:
-            first = first.strip()
-            if first:
-                try:
-                    obj = json.loads(first)
-                    handle_server_message(obj)
-                except json.JSONDecodeError:
-                    print("[CLIENT] Invalid JSON during welcome:", first)
-    except Exception as e:
-        print("[CLIENT] Error reading welcome from server:", e)
-        connected = False
-        sock.close()
+        first = run(events.__anext__())
+    except StopAsyncIteration:
+        print("Server closed connection before the welcome.")
+        return
+    handle_server_message(first)
+    if first.get("type") == "error":
+        # e.g. server_full: the server hangs up right after
+        run(c.close())
         return
+    asyncio.run_coroutine_threadsafe(pump_events(events), loop)
 
     while True:
-        username = input("Enter a username: ").strip()
+        try:
+            username = input("Enter a username: ").strip()
+        except EOFError:
+            run(c.close())
+            return
         if not username:
             continue
+        try:
+            frames = run(c.request("set_username", username=username))
+        except ServerError as e:
+            handle_server_message(e.reply)
+            continue
+        except ConnectionClosed:
+            print("Server closed connection during username handshake.")
+            return
+        for obj in frames:
+            handle_server_message(obj)
+        current_username = username
+        break
 
-        send_obj({"action": "set_username", "username": username})
+    print("You can now use %join, %groups, %post, etc. Type %help for commands.")
 
-        while True:
-            line = f.readline()
-            if not line:
-                print("Server closed connection during username handshake.")
-                connected = False
-                sock.close()
-                return
+# %connect <host> <port>, or %connect <socket path> for a server started with --unix
+def parse_connect(parts):
+    if len(parts) == 2 and unix_path(parts[1]):
+        return parts[1], DEFAULT_PORT
+    if len(parts) != 3:
+        raise ValueError("Usage: %connect <host> <port> or %connect <socket path>")
+    try:
+        return parts[1], int(parts[2])
+    except ValueError:
+        raise ValueError("Port must be an integer.")
+
+# turns a request command into (action, fields); ValueError carries the usage line
+def parse_request(parts):
+    name = parts[0].lower()
+    args = parts[1:]
+    if name in ("%join", "%users", "%leave"):
+        return name[1:], {"group": PUBLIC_GROUP}
+    if name == "%groups":
+        return "groups", {}
+    if name == "%stats":
+        return "stats", {}
+    if name == "%unread":
+        return "unread", {}
+    if name == "%ack":
+        if len(args) not in (1, 2):
+            raise ValueError("Usage: %ack <group> [id]")
+        if len(args) == 2:
+            return "ack", {"group": args[0], "id": parse_id(args[1])}
+        return "ack", {"group": args[0]}
+    if name == "%post":
+        if len(args) < 2:
+            raise ValueError("Usage: %post <subject> <body...>")
+        return "post", {"group": PUBLIC_GROUP, "subject": args[0], "body": " ".join(args[1:])}
+    if name == "%message":
+        if len(args) != 1:
+            raise ValueError("Usage: %message <id>")
+        return "get_message", {"group": PUBLIC_GROUP, "id": parse_id(args[0])}
+    if name == "%groupjoin":
+        if len(args) not in (1, 2) or args[1:] not in ([], ["digest"]):
+            raise ValueError("Usage: %groupjoin <group> [digest]")
+        if args[1:]:
+            return "join", {"group": args[0], "delivery": "digest"}
+        return "join", {"group": args[0]}
+    if name in ("%groupusers", "%groupleave"):
+        if len(args) != 1:
+            raise ValueError(f"Usage: {name} <group>")
+        return name[6:], {"group": args[0]}
+    if name == "%grouppost":
+        if len(args) < 3:
+            raise ValueError("Usage: %grouppost <group> <subject> <body...>")
+        return "post", {"group": args[0], "subject": args[1], "body": " ".join(args[2:])}
+    if name == "%postfile":
+        # the body comes from a file; big ones are uploaded in chunks
+        if len(args) != 3:
+            raise ValueError("Usage: %postfile <group> <subject> <path>")
+        try:
+            with open(args[2], encoding="utf-8") as f:
+                body = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            raise ValueError(f"Cannot read {args[2]}: {e}")
+        return "post", {"group": args[0], "subject": args[1], "body": body}
+    if name == "%groupmessage":
+        if len(args) != 2:
+            raise ValueError("Usage: %groupmessage <group> <id>")
+        return "get_message", {"group": args[0], "id": parse_id(args[1])}
+    raise ValueError("Unknown command. Type %help.")
+
+def parse_id(text):
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError("ID must be an integer.")
+
+# --script: run a command file without prompting. Requests are sent without
+# waiting for replies (at most `window` in flight); every result is printed as
+# one JSON line as it completes, then a summary line.
+async def run_script(lines, window):
+    c = None
+    sem = asyncio.Semaphore(window)
+    inflight = set()
+    latencies = []
+    by_action = {}
+    counts = {"ok": 0, "failed": 0}
+    events = [0]
+    expect_username = False
+
+    def emit(lineno, command, action, ok, started, **extra):
+        rec = {"line": lineno, "command": command, "action": action, "ok": ok}
+        if started is not None:
+            ms = (time.perf_counter() - started) * 1000
+            latencies.append(ms)
+            rec["latency_ms"] = round(ms, 3)
+        rec.update(extra)
+        counts["ok" if ok else "failed"] += 1
+        tally = by_action.setdefault(action, {"ok": 0, "failed": 0})
+        tally["ok" if ok else "failed"] += 1
+        sys.stdout.write(json.dumps(rec) + "\n")
+
+    async def one(lineno, command, action, fields):
+        started = time.perf_counter()
+        try:
+            frames = await c.request(action, **fields)
+        except ServerError as e:
+            emit(lineno, command, action, False, started, error=str(e), code=e.code)
+        except ConnectionClosed:
+            emit(lineno, command, action, False, started, error="connection closed")
+        else:
+            last = frames[-1]
+            extra = {"id": last["id"]} if action == "post" else {}
+            if last.get("cached"):
+                extra["cached"] = True
+            emit(lineno, command, action, True, started, **extra)
+        finally:
+            sem.release()
+
+    async def count_events(client):
+        async for _ in client:
+            events[0] += 1
+
+    async def settle():
+        if inflight:
+            await asyncio.gather(*inflight)
+
+    t0 = time.perf_counter()
+    for lineno, raw in enumerate(lines, 1):
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        if expect_username and not line.startswith("%"):
+            # same as the prompt: the line after %connect is the username
+            expect_username = False
+            started = time.perf_counter()
+            try:
+                await c.request("set_username", username=line)
+            except (ServerError, ConnectionClosed) as e:
+                emit(lineno, line, "set_username", False, started, error=str(e))
+            else:
+                emit(lineno, line, "set_username", True, started)
+            continue
+        expect_username = False
+        parts = line.split()
+        name = parts[0].lower()
 
-            line = line.strip()
-            if not line:
+        if name == "%connect":
+            await settle()
+            started = time.perf_counter()
+            if c is not None and not c.closed:
+                emit(lineno, line, "connect", False, None, error="already connected")
                 continue
-
             try:
-                obj = json.loads(line)
-            except json.JSONDecodeError:
-                print("[CLIENT] Invalid JSON during handshake:", line)
+                host, port = parse_connect(parts)
+                c = BulletinClient(cache=cache, auto_reconnect=auto_reconnect)
+                await c.connect(host, port)
+            except (ValueError, OSError) as e:
+                c = None
+                emit(lineno, line, "connect", False, started, error=str(e))
                 continue
-
-            if obj.get("type") == "error":
-                handle_server_message(obj)
-                break
-
-            handle_server_message(obj)
-
-            if obj.get("type") == "info" and obj.get("subtype") == "username_accepted":
-                current_username = username
-                username_accepted = True
-                break
-        else:
-            continue
-
-        if 'username_accepted' in locals() and username_accepted:
+            asyncio.ensure_future(count_events(c))
+            emit(lineno, line, "connect", True, started)
+            expect_username = True
+        elif name == "%exit":
             break
-
-    # receiver thread after accepting the username
-    receiver_thread = threading.Thread(target=receiver_loop, daemon=True)
-    receiver_thread.start()
-    print("You can now use %join, %groups, %post, etc. Type %help for commands.")
+        elif name == "%shutdown":
+            await settle()
+            if c is None or c.closed:
+                emit(lineno, line, "shutdown", False, None, error="not connected")
+                continue
+            await c.shutdown()
+            emit(lineno, line, "shutdown", True, None)
+        else:
+            try:
+                action, fields = parse_request(parts)
+            except ValueError as e:
+                emit(lineno, line, name.lstrip("%"), False, None, error=str(e))
+                continue
+            if c is None or c.closed:
+                emit(lineno, line, action, False, None, error="not connected")
+                continue
+            await sem.acquire()
+            task = asyncio.ensure_future(one(lineno, line, action, fields))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+
+    await settle()
+    elapsed = time.perf_counter() - t0
+    if c is not None:
+        await c.close()
+
+    lat = sorted(latencies)
+    def pct(p):
+        return round(lat[min(len(lat) - 1, int(p * len(lat)))], 3) if lat else None
+    summary = {
+        "commands": counts["ok"] + counts["failed"],
+        "ok": counts["ok"],
+        "failed": counts["failed"],
+        "elapsed_s": round(elapsed, 3),
+        "per_second": round((counts["ok"] + counts["failed"]) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "min": pct(0), "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99),
+            "max": round(lat[-1], 3) if lat else None,
+            "mean": round(sum(lat) / len(lat), 3) if lat else None,
+        },
+        "by_action": by_action,
+        "events": events[0],
+    }
+    sys.stdout.write(json.dumps({"summary": summary}) + "\n")
+    sys.stdout.flush()
+    return 1 if counts["failed"] else 0
 
 # help command options
 def print_help():
     print("Commands:")
-    print("  %connect <host> <port>")
+    print("  %connect <host> <port>   (or %connect <socket path>)")
     print("  %join                     (join public board)")
     print("  %post <subject> <body...>")
     print("  %users")
     print("  %leave")
     print("  %message <id>")
     print("  %groups")
-    print("  %groupjoin <group>")
+    print("  %groupjoin <group> [digest]  (digest: periodic summaries instead of live posts)")
     print("  %grouppost <group> <subject> <body...>")
     print("  %groupusers <group>")
     print("  %groupleave <group>")
     print("  %groupmessage <group> <id>")
+    print("  %postfile <group> <subject> <path>  (body read from a file)")
+    print("  %unread                   (unread count per joined group)")
+    print("  %ack <group> [id]         (mark read up to id, or everything)")
+    print("  %stats                    (server counters)")
     print("  %help")
     print("  %exit")
 
 def main_loop():
-    global connected, sock, sock_file
     print("Simple Bulletin Board Client (CLI)")
     print("Type %help for available commands.")
     while True:
@@ -209,144 +456,52 @@ def main_loop():
             print_help()
 
         elif name == "%connect":
-            if len(parts) != 3:
-                print("Usage: %connect <host> <port>")
-                continue
-            host = parts[1]
             try:
-                port = int(parts[2])
-            except ValueError:
-                print("Port must be an integer.")
+                host, port = parse_connect(parts)
+            except ValueError as e:
+                print(e)
                 continue
             connect_cmd(host, port)
 
-        elif name == "%join":
-            if not connected:
-                print("Not connected.")
-                continue
-            send_obj({"action": "join", "group": "public"})
-
-        elif name == "%post":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) < 3:
-                print("Usage: %post <subject> <body...>")
-                continue
-            subject = parts[1]
-            body = " ".join(parts[2:])
-            send_obj({"action": "post", "group": "public", "subject": subject, "body": body})
-
-        elif name == "%users":
-            if not connected:
-                print("Not connected.")
-                continue
-            send_obj({"action": "users", "group": "public"})
-
-        elif name == "%leave":
-            if not connected:
-                print("Not connected.")
-                continue
-            send_obj({"action": "leave", "group": "public"})
-
-        elif name == "%message":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) != 2:
-                print("Usage: %message <id>")
-                continue
-            try:
-                mid = int(parts[1])
-            except ValueError:
-                print("ID must be an integer.")
-                continue
-            send_obj({"action": "get_message", "group": "public", "id": mid})
-
-        elif name == "%groups":
-            if not connected:
-                print("Not connected.")
-                continue
-            send_obj({"action": "groups"})
-
-        elif name == "%groupjoin":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) != 2:
-                print("Usage: %groupjoin <group>")
-                continue
-            group = parts[1]
-            send_obj({"action": "join", "group": group})
-
-        elif name == "%grouppost":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) < 4:
-                print("Usage: %grouppost <group> <subject> <body...>")
-                continue
-            group = parts[1]
-            subject = parts[2]
-            body = " ".join(parts[3:])
-            send_obj({"action": "post", "group": group, "subject": subject, "body": body})
-
-        elif name == "%groupusers":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) != 2:
-                print("Usage: %groupusers <group>")
-                continue
-            group = parts[1]
-            send_obj({"action": "users", "group": group})
-
-        elif name == "%groupleave":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) != 2:
-                print("Usage: %groupleave <group>")
-                continue
-            group = parts[1]
-            send_obj({"action": "leave", "group": group})
-
-        elif name == "%groupmessage":
-            if not connected:
-                print("Not connected.")
-                continue
-            if len(parts) != 3:
-                print("Usage: %groupmessage <group> <id>")
-                continue
-            group = parts[1]
-            try:
-                mid = int(parts[2])
-            except ValueError:
-                print("ID must be an integer.")
-                continue
-            send_obj({"action": "get_message", "group": group, "id": mid})
-
         elif name == "%exit":
-            if connected:
+            if client is not None:
                 try:
-                    send_obj({"action": "exit"})
+                    run(client.close())
                 except Exception:
                     pass
-                try:
-                    sock.close()
-                except Exception:
-                    pass
-                connected = False
             print("Exiting client.")
             break
         elif name == "%shutdown":
-            if not connected:
+            if not is_connected():
                 print("Not connected.")
                 continue
-            send_obj({"action": "shutdown"})
-            
+            run(client.shutdown())
+
         else:
-            print("Unknown command. Type %help.")
+            try:
+                action, fields = parse_request(parts)
+            except ValueError as e:
+                print(e)
+                continue
+            send_cmd(action, **fields)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulletin board CLI client")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="keep seen messages in this file between runs")
+    parser.add_argument("--reconnect", action="store_true",
+                        help="reconnect automatically and resume the session if the connection drops")
+    parser.add_argument("--script", metavar="FILE",
+                        help="run the commands in FILE ('-' for stdin) pipelined, printing JSON results")
+    parser.add_argument("--window", type=int, default=256,
+                        help="with --script, how many requests may wait for a reply at once")
+    args = parser.parse_args()
+    if args.cache:
+        cache = MessageCache(args.cache)
+    auto_reconnect = args.reconnect
+    if args.script:
+        f = sys.stdin if args.script == "-" else open(args.script, encoding="utf-8")
+        with f:
+            sys.exit(asyncio.run(run_script(f, max(1, args.window))))
+    start_loop()
     main_loop()
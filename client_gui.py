@@ -4,6 +4,21 @@ from tkinter import ttk
 import socket
 import json
 import threading
+import time
+import queue
+import argparse
+from collections import deque
+
+from framing import LineFramer, iter_frames
+from msgcache import MessageCache
+from bbclient import unix_path, MAX_FRAME, INLINE_BODY, DOWNLOAD_WINDOW
+
+DEFAULT_SCROLLBACK = 5000   # lines kept in the log, oldest trimmed first
+DRAIN_INTERVAL_MS = 50      # how often queued server messages are rendered
+DRAIN_BATCH = 2000          # max queue items handled per drain, keeps Tk responsive
+RECONNECT_MIN = 0.5         # first reconnect delay in seconds, doubled per failure
+RECONNECT_MAX = 30.0
+SHOW_BODY = 1 << 16         # characters of a body shown in the log
 
 TEAL = "#0A66C2"
 TEAL_DARK = "#00695C"
@@ -11,14 +26,44 @@ WHITE = "#FFFFFF"
 BLACK = "#000000"
 
 class GuiClient:
-    def __init__(self, root):
+    def __init__(self, root, scrollback=DEFAULT_SCROLLBACK, cache_path=None,
+                 auto_reconnect=False):
         self.root = root
         self.root.title("Bulletin Board Client (GUI)")
         self.root.configure(bg=WHITE)
         self.sock = None
-        self.sock_file = None
+        self.sock_frames = None
         self.connected = False
         self.send_lock = threading.Lock()
+        # set from the server's retry_after hint when it throttles or sheds us
+        self.backoff_until = 0.0
+        # requests held back until backoff_until, in the order they were
+        # made; flushed by drain_inbox on the Tk thread
+        self.deferred = deque()
+        self.defer_lock = threading.Lock()
+        # server messages and log lines from any thread, drained on the Tk thread
+        self.inbox = queue.SimpleQueue()
+        self.scrollback = scrollback
+        # messages seen so far; answers repeat lookups and drives delta sync
+        self.cache = MessageCache(cache_path)
+        # what a reconnect needs to put the session back together
+        self.host = None
+        self.port = None
+        self.username = None
+        self.resume_token = None
+        self.joined_groups = set()
+        self.digest_groups = set()
+        # group -> unread count, from the server's unread/ack replies plus
+        # the posts that arrived since
+        self.unread = {}
+        self.exiting = False
+        self.auto_reconnect = auto_reconnect
+        # chunked transfers: post_begin req -> (group, subject, body), then
+        # upload id -> state; (group, id) -> state for downloads
+        self.next_upload_req = 0
+        self.pending_uploads = {}
+        self.uploads = {}
+        self.downloads = {}
 
         self.font_normal = ("Segoe UI", 10)
         self.font_bold = ("Segoe UI", 10, "bold")
@@ -28,6 +73,7 @@ class GuiClient:
         self.group_list = ["public", "group1", "group2", "group3", "group4", "group5"]
 
         self.build_ui()
+        self.root.after(DRAIN_INTERVAL_MS, self.drain_inbox)
 
     #styling helpers to make GUI look nice
     def style_button(self, button):
@@ -104,6 +150,11 @@ class GuiClient:
         self.style_button(self.groups_btn)
         self.groups_btn.grid(row=0, column=7, padx=10)
 
+        self.reconnect_var = tk.BooleanVar(value=self.auto_reconnect)
+        tk.Checkbutton(top, text="Auto-reconnect", variable=self.reconnect_var,
+                       bg=WHITE, fg=BLACK, selectcolor=WHITE, font=self.font_normal)\
+            .grid(row=0, column=8, padx=6)
+
         mid = self.create_card(self.root)
 
         tk.Label(mid, text="Group:", bg=WHITE, fg=BLACK, font=self.font_bold)\
@@ -134,6 +185,21 @@ class GuiClient:
         self.style_button(self.leave_btn)
         self.leave_btn.grid(row=0, column=4, padx=5)
 
+        # join in digest mode: periodic summaries instead of every new post
+        self.digest_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(mid, text="Digest", variable=self.digest_var,
+                       bg=WHITE, fg=BLACK, selectcolor=WHITE, font=self.font_normal)\
+            .grid(row=0, column=5, padx=6)
+
+        self.read_btn = tk.Button(mid, text="Mark Read",
+                                  command=self.mark_read, state=tk.DISABLED)
+        self.style_button(self.read_btn)
+        self.read_btn.grid(row=0, column=6, padx=5)
+
+        self.unread_label = tk.Label(mid, text="Unread: -", bg=WHITE, fg=BLACK,
+                                     font=self.font_normal)
+        self.unread_label.grid(row=1, column=0, columnspan=7, sticky="w", padx=5, pady=(6, 0))
+
         msg_frame = self.create_card(self.root)
         tk.Label(msg_frame, text="Subject:", bg=WHITE, fg=BLACK,
                  font=self.font_bold).grid(row=0, column=0, sticky="w", padx=5)
@@ -193,9 +259,38 @@ class GuiClient:
         self.style_button(exit_btn)
         exit_btn.pack(side=tk.RIGHT)
 
+    # safe from any thread; the line shows up on the next drain
     def log_line(self, text):
+        self.inbox.put(text)
+
+    def drain_inbox(self):
+        lines = []
+        for _ in range(DRAIN_BATCH):
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, str):
+                lines.append(item)
+            elif callable(item):
+                item()
+            else:
+                # may log more lines, they land behind what is already queued
+                self.handle_server_message(item)
+        if lines:
+            self.render_lines(lines)
+        self.flush_deferred()
+        backlog = not self.inbox.empty()
+        self.root.after(1 if backlog else DRAIN_INTERVAL_MS, self.drain_inbox)
+
+    def render_lines(self, lines):
+        # one insert, one trim and one scroll per batch instead of per line
+        lines = lines[-self.scrollback:]
         self.log.configure(state=tk.NORMAL)
-        self.log.insert(tk.END, text + "\n")
+        self.log.insert(tk.END, "\n".join(lines) + "\n")
+        total = int(self.log.index("end-1c").split(".")[0]) - 1
+        if total > self.scrollback:
+            self.log.delete("1.0", f"{total - self.scrollback + 1}.0")
         self.log.see(tk.END)
         self.log.configure(state=tk.DISABLED)
 
@@ -203,6 +298,19 @@ class GuiClient:
         if not self.connected or not self.sock:
             self.log_line("[CLIENT] Not connected.")
             return
+        if obj.get("action") != "pong":
+            with self.defer_lock:
+                wait = self.backoff_until - time.monotonic()
+                # once anything is held back, later requests queue behind it
+                # so they still reach the server in order
+                if wait > 0 or self.deferred:
+                    if not self.deferred:
+                        self.log_line(f"[CLIENT] Server asked us to back off, sending in {max(wait, 0):.2f}s")
+                    self.deferred.append(obj)
+                    return
+        self.write_obj(obj)
+
+    def write_obj(self, obj):
         data = (json.dumps(obj) + "\n").encode("utf-8")
         with self.send_lock:
             try:
@@ -210,6 +318,18 @@ class GuiClient:
             except Exception as e:
                 self.log_line(f"[CLIENT] Send error: {e}")
 
+    # runs on the Tk thread: sends what was held back once the backoff is over
+    def flush_deferred(self):
+        with self.defer_lock:
+            if not self.deferred or time.monotonic() < self.backoff_until:
+                return
+            held = list(self.deferred)
+            self.deferred.clear()
+            # send under the lock so nothing new can overtake the backlog
+            if self.connected and self.sock:
+                for obj in held:
+                    self.write_obj(obj)
+
     def connect(self):
         if self.connected:
             messagebox.showinfo("Info", "Already connected.")
@@ -217,6 +337,9 @@ class GuiClient:
         host = self.host_entry.get().strip()
         port_str = self.port_entry.get().strip()
         username = self.user_entry.get().strip()
+        # a socket path in the host field means a Unix domain socket, no port needed
+        if unix_path(host) and not port_str:
+            port_str = "0"
         if not host or not port_str or not username:
             messagebox.showerror("Error", "Host, port, and username are required.")
             return
@@ -226,51 +349,113 @@ class GuiClient:
             messagebox.showerror("Error", "Port must be an integer.")
             return
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((host, port))
-            f = s.makefile("r")
+            self.open_connection(host, port)
         except Exception as e:
             messagebox.showerror("Error", f"Cannot connect: {e}")
             return
-        self.sock = s
-        self.sock_file = f
-        self.connected = True
-        self.log_line(f"[CLIENT] Connected to {host}:{port}")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.resume_token = None
+        self.joined_groups = set()
+        self.digest_groups = set()
+        self.unread = {}
+        self.show_unread()
+        self.log_line(f"[CLIENT] Connected to {host}" if unix_path(host)
+                      else f"[CLIENT] Connected to {host}:{port}")
 
-        threading.Thread(target=self.receiver_loop, daemon=True).start()
-        
         self.send_obj({"action": "set_username", "username": username})
         self.groups_btn.config(state=tk.NORMAL)
         self.join_btn.config(state=tk.NORMAL)
         self.users_btn.config(state=tk.NORMAL)
         self.leave_btn.config(state=tk.NORMAL)
+        self.read_btn.config(state=tk.NORMAL)
         self.post_btn.config(state=tk.NORMAL)
         self.getmsg_btn.config(state=tk.NORMAL)
 
+    def open_connection(self, host, port):
+        path = unix_path(host)
+        if path is not None:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(path if path is not None else (host, port))
+        except OSError:
+            s.close()
+            raise
+        # requests held for the old connection mean nothing to a new one
+        with self.defer_lock:
+            self.deferred.clear()
+        self.sock = s
+        self.sock_frames = iter_frames(s, LineFramer(MAX_FRAME), self.on_oversize)
+        self.connected = True
+        threading.Thread(target=self.receiver_loop, daemon=True).start()
+
+    # runs on the Tk thread once the receiver notices the connection is gone
+    def on_disconnected(self):
+        if self.exiting or not self.reconnect_var.get() or self.username is None:
+            return
+        threading.Thread(target=self.reconnect_loop, daemon=True).start()
+
+    def reconnect_loop(self):
+        delay = RECONNECT_MIN
+        while not self.exiting:
+            self.log_line(f"[CLIENT] Reconnecting in {delay:.1f}s...")
+            time.sleep(delay)
+            try:
+                self.open_connection(self.host, self.port)
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            self.log_line(f"[CLIENT] Reconnected to {self.host}:{self.port}")
+            req = {"action": "set_username", "username": self.username}
+            if self.resume_token:
+                req["resume"] = self.resume_token
+            self.send_obj(req)
+            return
+
+    def on_oversize(self, err):
+        self.log_line(f"[CLIENT] Dropped oversized frame from server: {err}")
+
     def receiver_loop(self):
         try:
-            for line in self.sock_file:
-                line = line.strip()
+            for frame in self.sock_frames:
+                line = frame.strip()
                 if not line:
                     continue
                 try:
                     obj = json.loads(line)
-                except json.JSONDecodeError:
+                except ValueError:
                     self.log_line("[CLIENT] Invalid JSON from server")
                     continue
-                self.handle_server_message(obj)
+                self.inbox.put(obj)
         except Exception as e:
             self.log_line(f"[CLIENT] Connection error: {e}")
         finally:
             self.connected = False
             self.log_line("[CLIENT] Disconnected from server.")
+            self.inbox.put(self.on_disconnected)
 
     def handle_server_message(self, obj):
+        if self.cache.observe(obj):
+            self.log_line("[CLIENT] Server restarted, cleared the message cache.")
         t = obj.get("type")
-        if t == "info":
+        if t == "ping":
+            self.send_obj({"action": "pong"})
+        elif t == "pong":
+            pass
+        elif t == "info":
             self.log_line("[INFO] " + obj.get("message", ""))
+            if obj.get("subtype") == "username_accepted":
+                self.on_username_accepted(obj)
         elif t == "error":
             self.log_line("[ERROR] " + obj.get("message", ""))
+            self.pending_uploads.pop(obj.get("req"), None)
+            self.uploads.pop(obj.get("upload"), None)
+            if obj.get("retry_after") is not None:
+                self.backoff_until = max(self.backoff_until,
+                                         time.monotonic() + float(obj["retry_after"]))
         elif t == "event":
             ev = obj.get("event")
             if ev == "user_joined":
@@ -278,11 +463,18 @@ class GuiClient:
             elif ev == "user_left":
                 self.log_line(f"[EVENT] {obj.get('user')} left {obj.get('group')}")
             elif ev == "new_message":
+                self.count_unread(obj.get("group"), [obj])
                 self.log_line(
                     f"[NEW MESSAGE] ({obj.get('group')}) "
                     f"ID={obj.get('id')} From={obj.get('sender')} "
                     f"Date={obj.get('date')} Subject={obj.get('subject')}"
                 )
+            elif ev == "digest":
+                self.count_unread(obj.get("group"), obj.get("messages", []))
+                self.log_line(f"[DIGEST] ({obj.get('group')}) {obj.get('count')} new messages")
+                for m in obj.get("messages", []):
+                    self.log_line(f"  ID={m.get('id')} From={m.get('sender')} "
+                                  f"Date={m.get('date')} Subject={m.get('subject')}")
             else:
                 self.log_line(f"[EVENT] {obj}")
         elif t == "response":
@@ -302,26 +494,89 @@ class GuiClient:
             elif cmd == "users":
                 self.log_line(f"[USERS in {obj.get('group')}] " +
                               ", ".join(obj.get("users", [])))
+            elif cmd == "post":
+                self.log_line(f"[POSTED] Message {obj.get('id')} to {obj.get('group')}")
+            elif cmd == "post_begin":
+                self.start_upload(obj)
+            elif cmd == "post_chunk":
+                up = self.uploads.get(obj.get("upload"))
+                if up is not None:
+                    up["inflight"] -= 1
+                    self.pump_upload(obj.get("upload"))
+            elif cmd == "chunk":
+                self.on_chunk(obj)
+            elif cmd == "leave":
+                self.joined_groups.discard(obj.get("group"))
+                self.digest_groups.discard(obj.get("group"))
+                self.unread.pop(obj.get("group"), None)
+                self.show_unread()
+                self.log_line(f"[LEFT] {obj.get('group')}")
+            elif cmd == "ack":
+                self.unread[obj.get("group")] = obj.get("unread", 0)
+                self.show_unread()
+            elif cmd == "unread":
+                self.unread = {g: u.get("unread", 0) for g, u in obj.get("groups", {}).items()}
+                self.show_unread()
+            elif cmd == "join":
+                self.log_line("[REJOINED] " + ", ".join(obj.get("groups", [])))
+            elif cmd == "stats":
+                st = obj.get("stats", {})
+                self.log_line("[STATS] " + ", ".join(f"{k}={v}" for k, v in sorted(st.items())))
+            elif cmd == "sync":
+                self.handle_server_message(dict(obj, type="history"))
+            elif cmd == "message" and obj.get("chunked"):
+                self.start_download(obj)
             elif cmd == "message":
                 m = obj.get("message", {})
-                self.log_line(f"[MESSAGE {m.get('id')} in {m.get('group')}]")
+                cached = " (cached)" if obj.get("cached") else ""
+                self.log_line(f"[MESSAGE {m.get('id')} in {m.get('group')}]{cached}")
                 self.log_line(f" From: {m.get('sender')}")
                 self.log_line(f" Date: {m.get('timestamp')}")
                 self.log_line(f" Subject: {m.get('subject')}")
                 self.log_line(" Body:")
-                self.log_line(m.get("body", ""))
+                body = m.get("body", "")
+                if len(body) > SHOW_BODY:
+                    body = body[:SHOW_BODY] + f"\n[... {len(body) - SHOW_BODY} more characters not shown]"
+                self.log_line(body)
             else:
                 self.log_line(f"[RESPONSE] {obj}")
         elif t == "history":
             group = obj.get("group")
             msgs = obj.get("messages", [])
+            self.joined_groups.add(group)
             self.log_line(f"[HISTORY for {group}] (last {len(msgs)} messages)")
             for m in msgs:
                 self.log_line(f"  ID={m.get('id')} From={m.get('sender')} "
                               f"Date={m.get('timestamp')} Subject={m.get('subject')}")
+            if obj.get("more") and msgs:
+                # missed more than one page while away, fetch the next one
+                self.send_obj({"action": "sync", "group": group, "since": msgs[-1]["id"]})
+            if obj.get("command") != "sync":
+                # joined: pick up the badges for the new membership
+                self.send_obj({"action": "unread"})
         else:
             self.log_line(f"[SERVER] {obj}")
 
+    def on_username_accepted(self, obj):
+        self.resume_token = obj.get("resume_token", self.resume_token)
+        if obj.get("resumed"):
+            self.joined_groups = set(obj.get("groups", []))
+            self.send_obj({"action": "unread"})
+        elif self.joined_groups:
+            # the server lost our session (e.g. it restarted): rejoin everything
+            # in one request, asking only for what we missed
+            since = {}
+            for g in self.joined_groups:
+                last = self.cache.last_id(g)
+                if last is not None:
+                    since[g] = last
+            live = sorted(self.joined_groups - self.digest_groups)
+            digest = sorted(self.joined_groups & self.digest_groups)
+            if live:
+                self.send_obj({"action": "join", "groups": live, "since": since})
+            if digest:
+                self.send_obj({"action": "join", "groups": digest, "since": since, "delivery": "digest"})
+
     # group functionalities
     def get_groups(self):
         if not self.connected:
@@ -338,7 +593,33 @@ class GuiClient:
         if not self.connected:
             return
         g = self._current_group()
-        self.send_obj({"action": "join", "group": g})
+        req = {"action": "join", "group": g}
+        if self.digest_var.get():
+            req["delivery"] = "digest"
+            self.digest_groups.add(g)
+        else:
+            self.digest_groups.discard(g)
+        last = self.cache.last_id(g)
+        if last is not None:
+            # only ask for what we missed since the last message we saw
+            req["since"] = last
+        self.send_obj(req)
+
+    def mark_read(self):
+        if not self.connected:
+            return
+        self.send_obj({"action": "ack", "group": self._current_group()})
+
+    def count_unread(self, group, msgs):
+        if group not in self.unread:
+            return
+        self.unread[group] += sum(1 for m in msgs if m.get("sender") != self.username)
+        self.show_unread()
+
+    # unread badges for the joined groups
+    def show_unread(self):
+        badges = [f"{g} ({n})" for g, n in sorted(self.unread.items()) if n]
+        self.unread_label.config(text="Unread: " + (", ".join(badges) if badges else "none"))
 
     def group_users(self):
         if not self.connected:
@@ -361,12 +642,77 @@ class GuiClient:
         if not subj or not body:
             messagebox.showerror("Error", "Subject and body are required.")
             return
-        self.send_obj({"action": "post", "group": g, "subject": subj, "body": body})
+        size = len(body.encode("utf-8"))
+        if size > INLINE_BODY:
+            # too big for one frame: announce it, the chunks follow the reply
+            self.next_upload_req += 1
+            req = f"upload-{self.next_upload_req}"
+            self.pending_uploads[req] = (g, subj, body)
+            self.send_obj({"action": "post_begin", "group": g, "subject": subj,
+                           "size": size, "req": req})
+        else:
+            self.send_obj({"action": "post", "group": g, "subject": subj, "body": body})
         self.body_text.delete("1.0", tk.END)
 
-    def get_message(self):
-        if not self.connected:
+    def start_upload(self, obj):
+        pending = self.pending_uploads.pop(obj.get("req"), None)
+        if pending is None:
+            return
+        group, subj, body = pending
+        self.log_line(f"[UPLOADING] {len(body.encode('utf-8'))} bytes to {group}")
+        self.uploads[obj["upload"]] = {
+            "body": body, "step": obj["chunk_size"], "window": obj["window"],
+            "offset": 0, "seq": 0, "inflight": 0,
+        }
+        self.pump_upload(obj["upload"])
+
+    # keeps up to window chunks unacked, then finishes the post
+    def pump_upload(self, upload):
+        up = self.uploads[upload]
+        body = up["body"]
+        while up["inflight"] < up["window"] and up["offset"] < len(body):
+            piece = body[up["offset"]:up["offset"] + up["step"]]
+            self.send_obj({"action": "post_chunk", "upload": upload,
+                           "seq": up["seq"], "data": piece})
+            up["offset"] += len(piece)
+            up["seq"] += 1
+            up["inflight"] += 1
+        if up["offset"] >= len(body) and up["inflight"] == 0:
+            del self.uploads[upload]
+            self.send_obj({"action": "post_end", "upload": upload})
+
+    def start_download(self, obj):
+        m = obj.get("message", {})
+        key = (obj.get("group"), m.get("id"))
+        self.log_line(f"[DOWNLOADING] message {m.get('id')} ({m.get('size')} bytes)")
+        self.downloads[key] = {"reply": obj, "parts": {}, "offset": 0, "inflight": 0}
+        self.pump_download(key)
+
+    def pump_download(self, key):
+        d = self.downloads[key]
+        reply = d["reply"]
+        while d["inflight"] < DOWNLOAD_WINDOW and d["offset"] < reply["chars"]:
+            self.send_obj({"action": "get_chunk", "group": key[0], "id": key[1],
+                           "offset": d["offset"]})
+            d["offset"] += reply["chunk_size"]
+            d["inflight"] += 1
+        if d["offset"] >= reply["chars"] and d["inflight"] == 0:
+            del self.downloads[key]
+            body = "".join(d["parts"][off] for off in sorted(d["parts"]))
+            full = dict(reply, message=dict(reply["message"], body=body))
+            del full["chunked"]
+            self.handle_server_message(full)
+
+    def on_chunk(self, obj):
+        key = (obj.get("group"), obj.get("id"))
+        d = self.downloads.get(key)
+        if d is None:
             return
+        d["parts"][obj.get("offset")] = obj.get("data", "")
+        d["inflight"] -= 1
+        self.pump_download(key)
+
+    def get_message(self):
         g = self._current_group()
         mid = self.msgid_entry.get().strip()
         if not mid:
@@ -377,9 +723,18 @@ class GuiClient:
         except ValueError:
             messagebox.showerror("Error", "Message ID must be integer.")
             return
+        m = self.cache.get(g, mid_int)
+        if m is not None:
+            self.handle_server_message({"type": "response", "command": "message",
+                                        "group": g, "message": m, "cached": True})
+            return
+        if not self.connected:
+            return
         self.send_obj({"action": "get_message", "group": g, "id": mid_int})
 
     def on_exit(self):
+        self.exiting = True
+        self.cache.save()
         if self.connected and self.sock:
             try:
                 self.send_obj({"action": "exit"})
@@ -393,7 +748,16 @@ class GuiClient:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulletin board GUI client")
+    parser.add_argument("--scrollback", type=int, default=DEFAULT_SCROLLBACK,
+                        help="lines kept in the message log")
+    parser.add_argument("--cache", metavar="PATH",
+                        help="keep seen messages in this file between runs")
+    parser.add_argument("--reconnect", action="store_true",
+                        help="reconnect automatically if the connection drops")
+    args = parser.parse_args()
     root = tk.Tk()
     root.option_add("*disabledForeground", "white")
-    app = GuiClient(root)
+    app = GuiClient(root, scrollback=max(1, args.scrollback), cache_path=args.cache,
+                    auto_reconnect=args.reconnect)
     root.mainloop()
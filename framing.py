@@ -0,0 +1,148 @@
+# newline-delimited framing over a reusable byte buffer, shared by the
+# server and both clients
+
+DEFAULT_MAX_FRAME = 1 << 20      # longest line accepted, without the newline
+DEFAULT_BUFFER_SIZE = 1 << 14    # initial buffer, grown on demand up to the limit
+RECV_SIZE = 1 << 16
+MIN_FREE = 1 << 12               # compact or grow before reading into less than this
+SMALL_FRAME = 1 << 10            # batches starting with a shorter line are split in one go
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class LineFramer:
+    def __init__(self, max_frame=DEFAULT_MAX_FRAME, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.max_frame = max_frame
+        self.limit = max_frame + RECV_SIZE
+        self.buf = bytearray(min(buffer_size, self.limit))
+        self.view = memoryview(self.buf)
+        self.start = 0      # first unconsumed byte
+        self.end = 0        # one past the last received byte
+        self.scan = 0       # bytes before this offset hold no newline
+        self.discarding = False
+
+    def pending(self):
+        return self.end - self.start
+
+    def _make_room(self, need):
+        free = len(self.buf) - self.end
+        if free >= need:
+            return
+        # slide the unconsumed tail to the front; only the partial frame moves
+        n = self.end - self.start
+        if self.start:
+            self.view[:n] = self.view[self.start:self.end]
+            self.scan -= self.start
+            self.start = 0
+            self.end = n
+        if len(self.buf) - n >= need:
+            return
+        size = len(self.buf)
+        while size - n < need:
+            size *= 2
+        size = max(min(size, self.limit), n + need)
+        grown = bytearray(size)
+        grown[:n] = self.view[:n]
+        self.buf = grown
+        self.view = memoryview(self.buf)
+
+    def recv_into(self, sock):
+        self._make_room(MIN_FREE)
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        self._make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # returns the next complete line as a view into the buffer, or None if
+    # more data is needed. The view is only valid until the next recv/feed.
+    def next_frame(self):
+        while True:
+            nl = self.buf.find(b"\n", self.scan, self.end)
+            if nl < 0:
+                if self.discarding:
+                    self.start = self.scan = self.end
+                    return None
+                if self.end - self.start > self.max_frame:
+                    dropped = self.end - self.start
+                    self.start = self.scan = self.end
+                    self.discarding = True
+                    raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes ({dropped}+ buffered)")
+                self.scan = self.end
+                return None
+            begin = self.start
+            self.start = self.scan = nl + 1
+            if self.discarding:
+                # tail of an oversized frame, resync on the newline
+                self.discarding = False
+                continue
+            if nl - begin > self.max_frame:
+                raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes ({nl - begin})")
+            if self.start == self.end:
+                self.start = self.end = self.scan = 0
+            return self.view[begin:nl]
+
+
+    # all complete frames currently buffered, as bytes that stay valid
+    def frames(self):
+        out = []
+        if self.discarding or self.end - self.start > self.max_frame:
+            frame = self.next_frame()
+            if frame is None:
+                return out
+            out.append(bytes(frame))
+        buf = self.buf
+        view = self.view
+        end = self.end
+        limit = self.max_frame
+        begin = self.start
+        nl = buf.find(b"\n", self.scan, end)
+        last = buf.rfind(b"\n", nl, end) if 0 <= nl - begin < SMALL_FRAME else -1
+        if 0 <= last and last - begin <= limit:
+            # short lines, none of them can be over the limit: copy them out
+            # in one go and split, instead of a find and a copy per line
+            out.extend(bytes(view[begin:last]).split(b"\n"))
+            begin = last + 1
+        else:
+            while nl >= 0:
+                if nl - begin > limit:
+                    if out:
+                        # hand back what we have, the next call reports this one
+                        self.start = self.scan = begin
+                        return out
+                    self.start = self.scan = nl + 1
+                    raise FrameTooLarge(f"frame exceeds {limit} bytes ({nl - begin})")
+                out.append(bytes(view[begin:nl]))
+                begin = nl + 1
+                nl = buf.find(b"\n", begin, end)
+        self.start = begin
+        self.scan = end
+        if begin == end:
+            self.start = self.end = self.scan = 0
+        elif end - begin > limit:
+            # let next_frame report the oversized tail and start discarding
+            self.scan = begin
+        return out
+
+
+# yields frames from a blocking socket until the peer closes it
+def iter_frames(sock, framer, on_oversize=None):
+    while True:
+        while True:
+            try:
+                batch = framer.frames()
+            except FrameTooLarge as e:
+                if on_oversize is None:
+                    raise
+                on_oversize(e)
+                continue
+            if not batch:
+                break
+            yield from batch
+        if framer.recv_into(sock) == 0:
+            return
@@ -0,0 +1,144 @@
+# client-side cache of messages seen in history, new_message events and
+# get_message replies, optionally persisted to a JSON file between runs
+import json
+import os
+import threading
+
+DEFAULT_MAX_PER_GROUP = 1000
+
+
+class MessageCache:
+    def __init__(self, path=None, max_per_group=DEFAULT_MAX_PER_GROUP):
+        self.path = path
+        self.max_per_group = max_per_group
+        self.groups = {}        # group -> {id: message}, in insertion order
+        self.last_ids = {}      # group -> highest id seen, survives trimming
+        # the server run the cached ids belong to (server.py instance_id)
+        self.instance = None
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for group, msgs in data.get("groups", {}).items():
+            for m in msgs:
+                self.add(group, m)
+        for group, last in data.get("last_ids", {}).items():
+            self.last_ids[group] = max(last, self.last_ids.get(group, 0))
+        self.instance = data.get("instance")
+        self.dirty = False
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = {
+                "groups": {g: list(msgs.values()) for g, msgs in self.groups.items()},
+                "last_ids": dict(self.last_ids),
+                "instance": self.instance,
+            }
+            self.dirty = False
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def add(self, group, msg):
+        msg_id = msg.get("id")
+        if not isinstance(msg_id, int):
+            return
+        with self.lock:
+            msgs = self.groups.setdefault(group, {})
+            old = msgs.get(msg_id)
+            if old is not None and not self._same_message(old, msg):
+                old = None
+            if old is not None:
+                # keep a body we already have if this copy is headers only
+                merged = dict(old)
+                merged.update({k: v for k, v in msg.items() if v is not None})
+                msg = merged
+            msgs[msg_id] = msg
+            if msg_id > self.last_ids.get(group, 0):
+                self.last_ids[group] = msg_id
+            while len(msgs) > self.max_per_group:
+                del msgs[next(iter(msgs))]
+            self.dirty = True
+
+    # two copies of one message agree on sender and timestamp; a mismatch
+    # means the id was reused for another message
+    @staticmethod
+    def _same_message(old, new):
+        for key in ("sender", "timestamp"):
+            if old.get(key) is not None and new.get(key) is not None and old[key] != new[key]:
+                return False
+        return True
+
+    # called with the instance id of the server we are talking to. Returns
+    # True if the cache held messages of another server run and was emptied
+    # (and the cache file rewritten)
+    def set_instance(self, instance):
+        if not instance:
+            return False
+        with self.lock:
+            if instance == self.instance:
+                return False
+            cleared = bool(self.groups or self.last_ids)
+            self.groups.clear()
+            self.last_ids.clear()
+            self.instance = instance
+            self.dirty = True
+        self.save()
+        return cleared
+
+    # new_message events carry headers only
+    def add_event(self, event):
+        self.add(event.get("group"), {
+            "id": event.get("id"),
+            "sender": event.get("sender"),
+            "group": event.get("group"),
+            "subject": event.get("subject"),
+            "size": event.get("size"),
+            "timestamp": event.get("date"),
+        })
+
+    # full message if we have seen its body, otherwise None
+    def get(self, group, msg_id):
+        with self.lock:
+            m = self.groups.get(group, {}).get(msg_id)
+            if m is not None and "body" in m:
+                self.hits += 1
+                return m
+            self.misses += 1
+            return None
+
+    # takes in whatever a server frame tells us about messages. Returns True
+    # if it came from another server run and the cache was emptied
+    def observe(self, obj):
+        t = obj.get("type")
+        cleared = False
+        if t == "info" and "instance" in obj:
+            # ids from an earlier server run mean other messages now
+            cleared = self.set_instance(obj["instance"])
+        if t == "history" or (t == "response" and obj.get("command") == "sync"):
+            for m in obj.get("messages", []):
+                self.add(obj.get("group"), m)
+        elif t == "response" and obj.get("command") == "message":
+            m = obj.get("message", {})
+            self.add(obj.get("group") or m.get("group"), m)
+        elif t == "event" and obj.get("event") == "new_message":
+            self.add_event(obj)
+        elif t == "event" and obj.get("event") == "digest":
+            for e in obj.get("messages", []):
+                self.add_event(dict(e, group=obj.get("group")))
+        return cleared
+
+    def last_id(self, group):
+        return self.last_ids.get(group)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# replays a capture taken with `server.py --capture` against a running server:
+# every recorded connection is opened again and sends its frames at the
+# recorded times (divided by --speed, or as fast as possible with --speed 0).
+# Replies are compared with the captured ones and the reply latency per
+# action is reported next to what the capture saw.
+#
+#     python3 server.py --capture traffic.cap        # record, then stop it
+#     python3 server.py 5555 --no-rate-limits        # fresh server
+#     python3 replay.py traffic.cap --port 5555 --speed 10
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from capture import read_capture, OPEN, IN, OUT
+from framing import LineFramer, FrameTooLarge
+
+# fields that legitimately differ between two runs
+VOLATILE = {"req", "timestamp", "date", "resume_token", "retry_after", "instance", "trace"}
+TAG = "replay-"
+
+
+class Conn:
+    def __init__(self, conn_id, opened):
+        self.id = conn_id
+        self.opened = opened
+        self.frames = []        # (seq, t, data)
+        self.expected = {}      # seq -> [reply frames]
+        self.sent_at = {}       # seq -> t, from the capture
+        self.orig_latency = {}  # seq -> seconds, from the capture
+        self.actions = {}       # seq -> action
+        # filled in by the replay
+        self.got = {}
+        self.latency = {}
+        self.skipped = []
+
+
+def load(path):
+    conns = {}
+    for kind, conn_id, seq, t, data in read_capture(path):
+        if kind == OPEN:
+            conns[conn_id] = Conn(conn_id, t)
+            continue
+        c = conns.get(conn_id)
+        if c is None:
+            # capture started mid-connection; replay what we have
+            c = conns[conn_id] = Conn(conn_id, t)
+        if kind == IN:
+            c.frames.append((seq, t, data))
+            c.sent_at[seq] = t
+            c.actions[seq] = action_of(data)
+        elif kind == OUT:
+            c.expected.setdefault(seq, []).append(data)
+            if seq in c.sent_at:
+                c.orig_latency[seq] = t - c.sent_at[seq]
+    return sorted(conns.values(), key=lambda c: c.opened)
+
+
+def action_of(data):
+    try:
+        obj = json.loads(data)
+    except ValueError:
+        return "(invalid)"
+    return obj.get("action", "(none)") if isinstance(obj, dict) else "(invalid)"
+
+
+def normalize(obj):
+    if isinstance(obj, dict):
+        if obj.get("command") == "stats":
+            obj = dict(obj, stats=None)
+        return {k: normalize(v) for k, v in obj.items() if k not in VOLATILE}
+    if isinstance(obj, list):
+        return [normalize(v) for v in obj]
+    return obj
+
+
+def decode(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        return {"raw": data.decode("utf-8", "replace")}
+
+
+async def replay_conn(c, host, port, speed, start, timeout, allow_shutdown):
+    if speed:
+        await asyncio.sleep(max(0.0, start + c.opened / speed - time.monotonic()))
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = {}
+    # seq -> replies still expected; 0 is the welcome
+    waiting = {0: len(c.expected.get(0, []))}
+    done = asyncio.Event()
+    state = {"last_untagged": 0}
+
+    def settle(seq):
+        if (waiting.get(seq, 0) <= 0 and seq in sent and seq not in c.latency
+                and c.expected.get(seq)):
+            c.latency[seq] = time.monotonic() - sent[seq]
+        if all(n <= 0 for n in waiting.values()):
+            done.set()
+
+    async def read_loop():
+        framer = LineFramer(4 << 20)
+        while True:
+            data = await reader.read(1 << 16)
+            if not data:
+                break
+            framer.feed(data)
+            while True:
+                try:
+                    batch = framer.frames()
+                except FrameTooLarge:
+                    continue
+                if not batch:
+                    break
+                for frame in batch:
+                    line = frame.strip()
+                    if not line:
+                        continue
+                    obj = decode(line)
+                    t = obj.get("type")
+                    if t in ("ping", "event"):
+                        continue
+                    req = obj.get("req")
+                    if isinstance(req, str) and req.startswith(TAG):
+                        seq = int(req[len(TAG):])
+                    else:
+                        seq = state["last_untagged"]
+                    c.got.setdefault(seq, []).append(line)
+                    waiting[seq] = waiting.get(seq, 0) - 1
+                    settle(seq)
+        done.set()
+
+    reader_task = asyncio.ensure_future(read_loop())
+    try:
+        # take the welcome first, it carries no req to match it by
+        if waiting[0] > 0:
+            await asyncio.wait_for(done.wait(), timeout)
+        for seq, t, data in c.frames:
+            if speed:
+                await asyncio.sleep(max(0.0, start + t / speed - time.monotonic()))
+            obj = decode(data)
+            if c.actions[seq] == "shutdown" and not allow_shutdown:
+                c.skipped.append(seq)
+                continue
+            if isinstance(obj, dict) and "raw" not in obj:
+                # our own req, so every reply can be matched to its request
+                data = json.dumps(dict(obj, req=TAG + str(seq))).encode("utf-8")
+            else:
+                state["last_untagged"] = seq
+            waiting[seq] = waiting.get(seq, 0) + len(c.expected.get(seq, []))
+            done.clear()
+            sent[seq] = time.monotonic()
+            writer.write(data + b"\n")
+            await writer.drain()
+            settle(seq)
+        await asyncio.wait_for(done.wait(), timeout)
+    except (OSError, ConnectionError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+        reader_task.cancel()
+        await asyncio.gather(reader_task, return_exceptions=True)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    v = sorted(values)
+    pick = lambda p: round(v[min(len(v) - 1, int(p * len(v)))] * 1000, 3)
+    return {"n": len(v), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99),
+            "max": round(v[-1] * 1000, 3)}
+
+
+def compare(conns):
+    divergences = []
+    for c in conns:
+        for seq in sorted(set(c.expected) | set(c.got)):
+            if seq in c.skipped:
+                continue
+            want = [normalize(decode(d)) for d in c.expected.get(seq, [])]
+            have = [normalize(decode(d)) for d in c.got.get(seq, [])]
+            if want != have:
+                divergences.append({
+                    "conn": c.id, "seq": seq, "action": c.actions.get(seq, "(welcome)"),
+                    "expected": want, "got": have,
+                })
+    return divergences
+
+
+def report(conns, divergences, elapsed):
+    orig, new = {}, {}
+    for c in conns:
+        for seq, v in c.orig_latency.items():
+            orig.setdefault(c.actions[seq], []).append(v)
+        for seq, v in c.latency.items():
+            new.setdefault(c.actions[seq], []).append(v)
+    return {
+        "connections": len(conns),
+        "requests": sum(len(c.frames) for c in conns),
+        "skipped": sum(len(c.skipped) for c in conns),
+        "elapsed_s": round(elapsed, 3),
+        "divergences": len(divergences),
+        "latency_ms": {a: {"capture": percentiles(orig.get(a, [])),
+                           "replay": percentiles(new.get(a, []))}
+                       for a in sorted(set(orig) | set(new))},
+    }
+
+
+async def main(args):
+    conns = load(args.capture)
+    start = time.monotonic()
+    await asyncio.gather(*(replay_conn(c, args.host, args.port, args.speed, start,
+                                       args.timeout, args.allow_shutdown)
+                           for c in conns), return_exceptions=True)
+    elapsed = time.monotonic() - start
+    divergences = compare(conns)
+    summary = report(conns, divergences, elapsed)
+    if args.json:
+        print(json.dumps(dict(summary, first_divergences=divergences[:args.show])))
+    else:
+        print(f"{summary['connections']} connections, {summary['requests']} requests "
+              f"replayed in {summary['elapsed_s']}s ({summary['skipped']} skipped)")
+        print(f"{'action':<14}{'n':>7}{'capture p50':>13}{'p99':>9}{'replay p50':>12}{'p99':>9}  (ms)")
+        for action, lat in summary["latency_ms"].items():
+            o, r = lat["capture"], lat["replay"]
+            print(f"{action:<14}{max(o.get('n', 0), r.get('n', 0)):>7}"
+                  f"{o.get('p50', '-'):>13}{o.get('p99', '-'):>9}"
+                  f"{r.get('p50', '-'):>12}{r.get('p99', '-'):>9}")
+        print(f"{len(divergences)} divergent replies")
+        for d in divergences[:args.show]:
+            print(f"  conn {d['conn']} request {d['seq']} ({d['action']}):")
+            print(f"    expected {json.dumps(d['expected'])}")
+            print(f"    got      {json.dumps(d['got'])}")
+    return 1 if divergences else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a server capture")
+    parser.add_argument("capture")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="time scale: 1 = as recorded, 10 = ten times faster, 0 = no waiting")
+    parser.add_argument("--timeout", type=float, default=5.0,
+                        help="seconds to wait for outstanding replies after a connection's last request")
+    parser.add_argument("--show", type=int, default=10, help="divergences to print")
+    parser.add_argument("--allow-shutdown", action="store_true",
+                        help="replay shutdown requests too (skipped by default)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,202 @@
+# cold tier of the server's message store. Messages spilled out of memory are
+# appended to segment files that are read back through mmap, so the kernel
+# keeps them in the page cache when there is room and drops them when there
+# is not. Writes go through the file (several times faster than faulting in
+# fresh pages of the mapping) and show up in the mapping once flushed. One
+# record per message: the header as JSON, then the body as UTF-8. The files
+# only live as long as the server; nothing is read back after a restart.
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+
+# where each spilled message of one group is, in id order
+class GroupIndex:
+    __slots__ = ("ids", "seg", "off", "hlen", "blen")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.seg = array("I")
+        self.off = array("Q")
+        self.hlen = array("I")
+        self.blen = array("Q")
+
+
+class SegmentStore:
+    def __init__(self, directory=None, segment_size=64 << 20, cached_bodies=8):
+        self.own_dir = directory is None
+        self.dir = directory or tempfile.mkdtemp(prefix="bbseg-")
+        os.makedirs(self.dir, exist_ok=True)
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segments = []      # (path, file, mmap), the last one is written to
+        self.pos = 0            # write offset in the last segment
+        self.index = {}         # group -> GroupIndex
+        # bodies read back recently; get_chunk asks for the same one many times
+        self.cache = OrderedDict()
+        self.cached_bodies = cached_bodies
+        self.messages = 0
+        self.bytes = 0
+        self.spills = 0
+        self.spill_time = 0.0
+        self.spill_max = 0.0
+        self.loads = 0
+        self.load_time = 0.0
+        self.load_max = 0.0
+
+    def _new_segment(self, size):
+        if self.segments:
+            self.segments[-1][1].flush()
+        path = os.path.join(self.dir, f"seg-{len(self.segments):06d}.dat")
+        f = open(path, "w+b")
+        # sparse until written
+        f.truncate(size)
+        self.segments.append((path, f, mmap.mmap(f.fileno(), size)))
+        self.pos = 0
+
+    def _write(self, data):
+        if not self.segments or self.pos + len(data) > len(self.segments[-1][2]):
+            self._new_segment(max(self.segment_size, len(data)))
+        f = self.segments[-1][1]
+        start = self.pos
+        f.seek(start)
+        f.write(data)
+        self.pos += len(data)
+        return len(self.segments) - 1, start
+
+    # items: (header, body) pairs of one group, oldest first and newer than
+    # anything already spilled for it. Until the caller has dropped them from
+    # memory they are in both tiers; headers_after takes a count so readers
+    # only see the part that is no longer hot.
+    def spill(self, group, items):
+        started = time.perf_counter()
+        with self.lock:
+            idx = self.index.get(group)
+            if idx is None:
+                idx = self.index[group] = GroupIndex()
+            for header, body in items:
+                h = json.dumps(header).encode("utf-8")
+                b = body.encode("utf-8")
+                seg, off = self._write(h + b)
+                idx.ids.append(header["id"])
+                idx.seg.append(seg)
+                idx.off.append(off)
+                idx.hlen.append(len(h))
+                idx.blen.append(len(b))
+                self.bytes += len(h) + len(b)
+            if self.segments:
+                self.segments[-1][1].flush()
+            self.messages += len(items)
+            elapsed = time.perf_counter() - started
+            self.spills += 1
+            self.spill_time += elapsed
+            self.spill_max = max(self.spill_max, elapsed)
+
+    def _loaded(self, started):
+        elapsed = time.perf_counter() - started
+        self.loads += 1
+        self.load_time += elapsed
+        self.load_max = max(self.load_max, elapsed)
+
+    def _locate(self, group, msg_id):
+        idx = self.index.get(group)
+        if idx is None:
+            return None, -1
+        i = bisect_left(idx.ids, msg_id)
+        if i < len(idx.ids) and idx.ids[i] == msg_id:
+            return idx, i
+        return None, -1
+
+    def _header(self, idx, i):
+        mm = self.segments[idx.seg[i]][2]
+        off = idx.off[i]
+        return json.loads(mm[off:off + idx.hlen[i]])
+
+    def find(self, group, msg_id):
+        started = time.perf_counter()
+        with self.lock:
+            idx, i = self._locate(group, msg_id)
+            if idx is None:
+                return None
+            header = self._header(idx, i)
+            self._loaded(started)
+        return header
+
+    def body(self, group, msg_id):
+        started = time.perf_counter()
+        with self.lock:
+            body = self.cache.get(msg_id)
+            if body is not None:
+                self.cache.move_to_end(msg_id)
+                return body
+            idx, i = self._locate(group, msg_id)
+            if idx is None:
+                return None
+            mm = self.segments[idx.seg[i]][2]
+            off = idx.off[i] + idx.hlen[i]
+            body = mm[off:off + idx.blen[i]].decode("utf-8")
+            self.cache[msg_id] = body
+            if len(self.cache) > self.cached_bodies:
+                self.cache.popitem(last=False)
+            self._loaded(started)
+        return body
+
+    # up to limit headers with id > since among the group's first count
+    # spilled messages, and how many of those come after since in total
+    def headers_after(self, group, since, limit, count):
+        started = time.perf_counter()
+        with self.lock:
+            idx = self.index.get(group)
+            if idx is None:
+                return [], 0
+            count = min(count, len(idx.ids))
+            i = bisect_right(idx.ids, since, 0, count)
+            end = min(count, i + limit)
+            headers = [self._header(idx, j) for j in range(i, end)]
+            if headers:
+                self._loaded(started)
+        return headers, count - i
+
+    # how many of the group's first count spilled messages have id <= msg_id
+    def count_upto(self, group, msg_id, count):
+        with self.lock:
+            idx = self.index.get(group)
+            if idx is None:
+                return 0
+            return bisect_right(idx.ids, msg_id, 0, min(count, len(idx.ids)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "cold_messages": self.messages,
+                "cold_bytes": self.bytes,
+                "segments": len(self.segments),
+                "spills": self.spills,
+                "spill_ms_avg": round(1000 * self.spill_time / self.spills, 3) if self.spills else 0.0,
+                "spill_ms_max": round(1000 * self.spill_max, 3),
+                "loads": self.loads,
+                "load_ms_avg": round(1000 * self.load_time / self.loads, 3) if self.loads else 0.0,
+                "load_ms_max": round(1000 * self.load_max, 3),
+            }
+
+    def close(self):
+        with self.lock:
+            for path, f, mm in self.segments:
+                mm.close()
+                f.close()
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            self.segments = []
+            self.index.clear()
+            self.cache.clear()
+        if self.own_dir:
+            shutil.rmtree(self.dir, ignore_errors=True)
@@ -1,30 +1,325 @@
 #!/usr/bin/env python3
+import errno
+import os
 import socket
+import stat
 import threading
 import json
-import sys
+import time
+import argparse
+import secrets
+import random
+import itertools
+import selectors
+from collections import deque
 from datetime import datetime
 
+from framing import LineFramer, iter_frames
+import capture as cap
+from segments import SegmentStore
+
 DEFAULT_PORT = 12345
 
+# runtime settings, overridable from the command line
+settings = {
+    "ping_interval": 15.0,   # seconds of silence before the server pings a client
+    "idle_timeout": 45.0,    # seconds of silence before a client is reaped
+    "flush_delay": 0.001,    # max seconds a burst of frames waits to grow before it is written
+    "max_batch": 256,        # max frames written by one sendmsg call
+    "close_flush_timeout": 1.0,
+    # frames queued for one client before it counts as too slow and is
+    # disconnected (0 = no cap). As many as the whole server queues before
+    # shedding, so a client pipelining a long burst of requests still fits
+    "max_pending": 100000,
+    # frames taken from each lane per round when building a batch, so busy
+    # higher lanes can never starve the lower ones
+    "lane_weights": (8, 4, 1),
+    "max_frame": 1 << 20,    # longest request line in bytes
+    "max_body": 1 << 19,     # longest post body in bytes
+    # bodies over inline_body bytes are fetched with get_chunk instead of
+    # coming back whole from get_message; uploads over max_body go through
+    # post_begin/post_chunk/post_end
+    "inline_body": 1 << 16,
+    "chunk_size": 1 << 16,   # characters per chunk, both directions
+    "upload_window": 8,      # chunks a client may send ahead of the acks
+    "max_upload": 64 << 20,  # longest chunked body in bytes
+    "max_uploads": 4,        # unfinished uploads per connection
+    # per-connection token buckets: action -> (tokens per second, burst)
+    "rate_limits": {
+        "post": (20.0, 40),
+        "post_begin": (20.0, 40),
+        "get_message": (50.0, 100),
+        "join": (10.0, 20),
+        "leave": (10.0, 20),
+        "users": (20.0, 40),
+        "groups": (20.0, 40),
+        "sync": (20.0, 40),
+        "ack": (50.0, 100),
+        "unread": (20.0, 40),
+        # 64 KiB chunks, so about 12 MiB/s each way per connection
+        "post_chunk": (200.0, 400),
+        "get_chunk": (200.0, 400),
+        "post_end": (20.0, 40),
+    },
+    # shed load when this many frames are queued server-wide ...
+    "shed_queue_depth": 100000,
+    # ... or when the average wait for the state lock goes over this many seconds
+    "shed_lock_wait": 0.05,
+    "shed_retry_after": 1.0,
+    "max_sync": 500,         # most messages returned by one delta sync
+    # seconds a dropped connection's memberships are kept for resume
+    "resume_window": 60.0,
+    # fraction of posts traced when tracing is on (--trace-file); a post with
+    # "trace": true is always traced
+    "trace_sample": 0.01,
+    "backlog": 128,          # listen() backlog for each listener
+    # open connections at most; further ones get a server_full error and are
+    # closed right away (0 = no cap)
+    "max_connections": 4096,
+    # seconds shutdown waits for queued output to reach the clients
+    "shutdown_timeout": 5.0,
+    # newest messages per group that readers get from the group snapshot;
+    # older ones are looked up under state_lock (at least 2, the join history)
+    "snapshot_window": 256,
+    # estimated bytes of message headers and bodies kept in memory; past it
+    # the oldest messages are spilled to segment files (0 = never spill)
+    "memory_budget": 256 << 20,
+    "hot_window": 64,        # newest messages per group that are never spilled
+    "spill_dir": None,       # where segment files go, a temp dir by default
+    # members who joined with "delivery": "digest" get one digest event per
+    # group every digest_interval seconds instead of a new_message per post,
+    # or sooner once digest_max posts are waiting
+    "digest_interval": 30.0,
+    "digest_max": 100,
+}
+
+DELIVERY_MODES = ("live", "digest")
+
+# outbound priority classes, drained in this order
+LANE_REPLY = 0      # response/error/info/history to the client's own commands
+LANE_MESSAGE = 1    # new_message events
+LANE_PRESENCE = 2   # user_joined/user_left and other events
+LANE_NAMES = ("reply", "message", "presence")
+
 class ClientInfo:
     def __init__(self, sock, addr):
         self.sock = sock
         self.addr = addr
         self.username = None
         self.groups = set()
-        self.send_lock = threading.Lock()
+        # (enqueue time, frame) per lane, flushed together by the writer thread
+        self.out_cond = threading.Condition()
+        self.lanes = [deque() for _ in LANE_NAMES]
+        self.pending = 0
+        self.writer = None
+        self.last_seen = time.monotonic()
+        self.last_ping = 0.0
+        # set once nothing more is queued for the client: it is being
+        # disconnected or its output was abandoned
+        self.closed = False
+        # set by the first disconnect_client
+        self.disconnected = False
+        self.buckets = {}
+        # "req" of the request being handled, echoed on its replies
+        self.req = None
+        self.resume_token = None
+        # connection id and request count, only used for traffic capture
+        self.conn_id = 0
+        self.in_seq = 0
+        # chunked uploads in progress: id -> {"group", "subject", "size", "parts", ...}
+        self.uploads = {}
+        self.next_upload = 0
+        # when the current request was read and parsed, only kept while tracing
+        self.t_read = 0
+        self.t_parsed = 0
 
     def __repr__(self):
         return f"<Client {self.username}@{self.addr}>"
 
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    # takes a token, returns 0 on success or the seconds until one is available
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# one sampled post on its way through the server. Times are
+# time.monotonic_ns(), so a client on the same host can line them up with
+# its own clock.
+class PostTrace:
+    def __init__(self, trace_id, t_read, t_parsed):
+        self.id = trace_id
+        self.stages = {"read": t_read, "parsed": t_parsed}
+        self.info = {}
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.sends = []
+
+    def mark(self, stage):
+        self.stages[stage] = time.monotonic_ns()
+
+    # called once, before the first frame is queued
+    def expect(self, n):
+        with self.lock:
+            self.pending += n
+            done = self.pending == 0
+        if done:
+            self.finish()
+
+    # a traced frame was written (ok) or thrown away
+    def sent(self, username, ok=True):
+        t = time.monotonic_ns() if ok else None
+        with self.lock:
+            self.sends.append((username, t))
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            self.finish()
+
+    def finish(self):
+        t0 = self.stages["read"]
+        tracer.write(dict(self.info, **{
+            "trace": self.id,
+            "t_read_ns": t0,
+            "stages_us": {k: (v - t0) / 1000 for k, v in self.stages.items()},
+            "sends": [{"user": u, "us": None if t is None else (t - t0) / 1000}
+                      for u, t in self.sends],
+        }))
+
+
+# sampled traces as JSON lines
+class TraceLog:
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "w", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.records = 0
+
+    def new_trace(self, client):
+        with self.lock:
+            trace_id = self.next_id
+            self.next_id += 1
+        return PostTrace(trace_id, client.t_read, client.t_parsed)
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            if self.f is not None:
+                self.f.write(line)
+                self.records += 1
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+# a Lock that keeps a moving average of how long acquirers had to wait. The
+# average also halves every half_life seconds, so a spike fades even when
+# nothing takes the lock (requests shed because of it never do)
+class TimedLock:
+    def __init__(self, half_life=0.5):
+        self._lock = threading.Lock()
+        self.half_life = half_life
+        self._avg = 0.0
+        self._stamp = time.monotonic()
+
+    def _decayed(self, now):
+        return self._avg * 0.5 ** ((now - self._stamp) / self.half_life)
+
+    @property
+    def avg_wait(self):
+        return self._decayed(time.monotonic())
+
+    def __enter__(self):
+        if self._lock.acquire(False):
+            now = time.monotonic()
+            self._avg = self._decayed(now) * 0.9
+            self._stamp = now
+            return self
+        start = time.perf_counter()
+        self._lock.acquire()
+        waited = time.perf_counter() - start
+        now = time.monotonic()
+        self._avg = self._decayed(now) * 0.9 + waited * 0.1
+        self._stamp = now
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
 clients_lock = threading.Lock()
 clients = set()
 username_to_client = {}
+# sessions whose connection dropped: token -> {"username", "groups", "expires"},
+# plus username -> token so the name stays reserved until it expires
+detached_sessions = {}
+detached_users = {}
+
+# read-only view of one group. Every write to a group's members or messages
+# (under state_lock) builds a new one and swaps it in with a single dict
+# assignment, so readers take groups[g]["snap"] once and use it without the
+# lock. Nothing in a snapshot is modified after it is published.
+class GroupSnapshot:
+    __slots__ = ("members", "users", "digest", "recent", "total")
+
+    def __init__(self, members, users, digest, recent, total):
+        self.members = members  # frozenset of usernames
+        self.users = users      # the same names sorted, as sent in users replies
+        self.digest = digest    # frozenset of the members in digest mode
+        self.recent = recent    # tuple of the newest snapshot_window message headers
+        self.total = total      # number of messages in the group
+
+
+# how far a user has read in one group. read is the number of the group's
+# messages with id <= last, so the unread count is the group's total minus
+# read and posting never has to touch the cursors of the other members.
+# first_unread is looked up once per cursor position: messages are never
+# removed, so the answer does not change.
+class ReadCursor:
+    __slots__ = ("last", "read", "first_unread")
+
+    def __init__(self, last, read):
+        self.last = last
+        self.read = read
+        self.first_unread = None
 
-state_lock = threading.Lock()
+
+state_lock = TimedLock()
+# group -> {"members": set, "digest": set, "messages": list, "spilled": int,
+# "pending_digest": list, "cursors": dict, "snap": GroupSnapshot}; all but snap
+# are only touched under state_lock. "messages" is the in-memory (hot) tier,
+# the "spilled" older ones are in store. "digest" is the subset of members in
+# digest mode and "pending_digest" the posts their next digest will list.
+# "cursors" maps username -> ReadCursor and outlives the membership.
 groups = {}  
+# message id -> body for hot messages. The per-group message lists only hold
+# headers and the body size, so history, sync and fan-out never touch the bodies
+bodies = {}
 next_msg_id = 1
+# cold tier, a segments.SegmentStore created by the first spill
+store = None
+spill_lock = threading.Lock()
+# estimated memory held by hot messages, checked against memory_budget
+hot_bytes = 0
+# rough cost of one hot message besides its body: the header dict and its
+# strings plus the bodies entry
+MESSAGE_OVERHEAD = 600
 
 # groups are premade as mentioned in the assignment
 PREDEFINED_GROUPS = ["group1", "group2", "group3", "group4", "group5"]
@@ -32,60 +327,484 @@ PUBLIC_GROUP = "public"
 
 # to shutdown the sever
 server_stop_event = threading.Event()
+# new for every server run and sent in the welcome and username_accepted:
+# message ids start again at 1 after a restart, so clients drop what they
+# cached from an earlier run when it changes
+instance_id = secrets.token_hex(8)
+# write end of the socketpair that wakes the accept loop, set by run_server
+wakeup = None
+
+# capture.CaptureWriter when started with --capture
+capture = None
+# TraceLog when started with --trace-file
+tracer = None
+
+stats_lock = threading.Lock()
+stats = {
+    "pings_sent": 0,
+    "pongs_received": 0,
+    "connections_reaped": 0,
+    "usernames_reclaimed": 0,
+    "memberships_reclaimed": 0,
+    "frames_sent": 0,
+    "send_syscalls": 0,
+    "throttled": 0,
+    "shed": 0,
+    "slow_consumers": 0,     # clients disconnected for falling max_pending frames behind
+    "paced": 0,              # chunk requests held back by their bucket or an overload
+    "sessions_detached": 0,
+    "sessions_resumed": 0,
+    "sessions_expired": 0,
+    "sessions_replaced": 0,  # parked sessions dropped by a plain login with the name
+    "connections_refused": 0,
+    "hot_hits": 0,
+    "cold_hits": 0,
+    "digests_sent": 0,
+    "digest_skipped": 0,     # new_message frames not sent to digest members
+}
+
+# frames queued for all clients, used to decide when to shed load
+queue_lock = threading.Lock()
+queued_frames = 0
+# per lane: frames sent, total and worst queueing delay in seconds
+lane_stats = [{"frames": 0, "wait_total": 0.0, "wait_max": 0.0} for _ in LANE_NAMES]
+
+
+def bump_stat(name, n=1):
+    with stats_lock:
+        stats[name] = stats.get(name, 0) + n
 
 
 def init_groups():
+    global store, hot_bytes
     with state_lock:
         groups.clear()
-        groups[PUBLIC_GROUP] = {"members": set(), "messages": []}
-        for g in PREDEFINED_GROUPS:
-            groups[g] = {"members": set(), "messages": []}
+        bodies.clear()
+        hot_bytes = 0
+        if store is not None:
+            store.close()
+            store = None
+        for g in [PUBLIC_GROUP] + PREDEFINED_GROUPS:
+            groups[g] = {"members": set(), "digest": set(), "messages": [], "spilled": 0,
+                         "pending_digest": [], "cursors": {}}
+            refresh_snapshot(groups[g])
+
+
+# publishes a new snapshot of gdata; call with state_lock held after changing
+# its members and/or messages. The part that did not change is reused.
+def refresh_snapshot(gdata, members=True, messages=True):
+    old = gdata.get("snap")
+    if members or old is None:
+        names = frozenset(gdata["members"])
+        users = tuple(sorted(names))
+        digest = frozenset(gdata["digest"])
+    else:
+        names, users, digest = old.members, old.users, old.digest
+    if messages or old is None:
+        msgs = gdata["messages"]
+        window = max(2, settings["snapshot_window"])
+        recent = tuple(msgs[-window:])
+        total = len(msgs) + gdata["spilled"]
+    else:
+        recent, total = old.recent, old.total
+    gdata["snap"] = GroupSnapshot(names, users, digest, recent, total)
+
+
+# True if the snapshot holds every message of its group with an id >= msg_id
+def snapshot_covers(snap, msg_id):
+    recent = snap.recent
+    return len(recent) == snap.total or recent[0]["id"] <= msg_id
+
+
+# messages_after for readers: from the snapshot when its window reaches back
+# far enough, otherwise from the full list under the lock
+def read_messages_after(group, since, limit):
+    snap = groups[group]["snap"]
+    if snapshot_covers(snap, since):
+        bump_stat("hot_hits")
+        return messages_after(snap.recent, since, limit)
+    with state_lock:
+        return stored_messages_after(group, since, limit)
+
+
+# messages_after over both tiers; call with state_lock held
+def stored_messages_after(group, since, limit):
+    gdata = groups[group]
+    hot = gdata["messages"]
+    if not gdata["spilled"] or (hot and hot[0]["id"] <= since):
+        bump_stat("hot_hits")
+        return messages_after(hot, since, limit)
+    bump_stat("cold_hits")
+    msgs, cold_after = store.headers_after(group, since, limit, gdata["spilled"])
+    msgs += hot[:limit - len(msgs)]
+    return msgs, cold_after + len(hot) > limit
+
+
+# header of a message in either tier; call with state_lock held
+def find_stored(group, msg_id):
+    gdata = groups[group]
+    hot = gdata["messages"]
+    if gdata["spilled"] and (not hot or msg_id < hot[0]["id"]):
+        return store.find(group, msg_id)
+    return find_message(hot, msg_id)
 
 
-def send_json(client: ClientInfo, obj: dict):
+# number of messages in the group with id <= msg_id; call with state_lock held
+def count_upto(group, msg_id):
+    gdata = groups[group]
+    hot = gdata["messages"]
+    if gdata["spilled"] and (not hot or msg_id < hot[0]["id"]):
+        return store.count_upto(group, msg_id, gdata["spilled"])
+    lo, hi = 0, len(hot)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if hot[mid]["id"] <= msg_id:
+            lo = mid + 1
+        else:
+            hi = mid
+    return gdata["spilled"] + lo
+
+
+def message_cost(msg):
+    return MESSAGE_OVERHEAD + msg["size"]
+
+
+# moves the oldest hot messages, across all groups, to the cold tier until
+# hot_bytes is a tenth under the budget again. The newest hot_window messages
+# of every group stay. The slow part, writing the segments, runs without
+# state_lock: only spills remove messages from the front of a hot list, and
+# one spill runs at a time, so the messages picked stay where they are.
+def spill_messages():
+    global store, hot_bytes
+    if not spill_lock.acquire(False):
+        # someone else is already at it
+        return
     try:
-        data = (json.dumps(obj) + "\n").encode("utf-8")
-        with client.send_lock:
-            client.sock.sendall(data)
+        with state_lock:
+            if store is None:
+                store = SegmentStore(settings["spill_dir"])
+            keep = max(2, settings["hot_window"])
+            target = settings["memory_budget"] * 0.9
+            cut = {g: 0 for g in groups}
+            freed = 0
+            while hot_bytes - freed > target:
+                oldest = None
+                for g, gdata in groups.items():
+                    msgs = gdata["messages"]
+                    i = cut[g]
+                    if len(msgs) - i > keep and (oldest is None or msgs[i]["id"] < oldest_id):
+                        oldest, oldest_id = g, msgs[i]["id"]
+                if oldest is None:
+                    # every group is down to its hot window
+                    break
+                freed += message_cost(groups[oldest]["messages"][cut[oldest]])
+                cut[oldest] += 1
+            moving = {g: groups[g]["messages"][:n] for g, n in cut.items() if n}
+
+        for g, msgs in moving.items():
+            store.spill(g, [(m, bodies[m["id"]]) for m in msgs])
+
+        # on disk now, so a reader that misses a body in memory finds it there
+        with state_lock:
+            for g, msgs in moving.items():
+                gdata = groups[g]
+                for m in msgs:
+                    del bodies[m["id"]]
+                del gdata["messages"][:len(msgs)]
+                gdata["spilled"] += len(msgs)
+                refresh_snapshot(gdata, members=False)
+            hot_bytes -= freed
+    finally:
+        spill_lock.release()
+
+
+def lane_for(obj: dict):
+    if obj.get("type") != "event":
+        return LANE_REPLY
+    if obj.get("event") in ("new_message", "digest"):
+        return LANE_MESSAGE
+    return LANE_PRESENCE
+
+
+def send_json(client: ClientInfo, obj: dict, lane=None, trace=None):
+    global queued_frames
+    if lane is None:
+        lane = lane_for(obj)
+    if client.req is not None and lane == LANE_REPLY and obj.get("type") != "ping":
+        obj = dict(obj, req=client.req)
+    data = (json.dumps(obj) + "\n").encode("utf-8")
+    # captured replies are recorded by the writer once they are on the wire,
+    # with the seq of the request they answer
+    seq = None
+    if capture is not None and lane == LANE_REPLY and obj.get("type") != "ping":
+        seq = client.in_seq
+    cap = settings["max_pending"]
+    with client.out_cond:
+        if client.closed:
+            if trace is not None:
+                trace.sent(client.username, False)
+            return
+        overflow = cap and client.pending >= cap
+        if not overflow:
+            client.lanes[lane].append((time.monotonic(), data, trace, seq))
+            client.pending += 1
+            client.out_cond.notify()
+    if overflow:
+        bump_stat("slow_consumers")
+        print(f"Client {client.addr} ({client.username}) fell {cap} frames behind, disconnecting")
+        abandon_output(client, [trace])
+        return
+    with queue_lock:
+        queued_frames += 1
+
+
+# gives up on a client that cannot take more output: what is queued is
+# dropped, nothing more is queued, and the socket is shut down so the reader
+# sees it and disconnects the client like any dropped connection
+def abandon_output(client: ClientInfo, traces=()):
+    with client.out_cond:
+        client.closed = True
+        traces = list(traces) + [e[2] for lane in client.lanes for e in lane]
+        for lane in client.lanes:
+            lane.clear()
+        dropped = client.pending
+        client.pending = 0
+        client.out_cond.notify()
+    frames_dequeued(dropped)
+    for trace in traces:
+        if trace is not None:
+            trace.sent(client.username, False)
+    try:
+        client.sock.shutdown(socket.SHUT_RDWR)
     except OSError:
         pass
 
-# function to send an event to all users in a group 
-def broadcast_event(group_name: str, event: dict, exclude_username=None):
-    with state_lock:
-        members = list(groups.get(group_name, {}).get("members", []))
+
+def frames_dequeued(n):
+    global queued_frames
+    with queue_lock:
+        queued_frames -= n
+
+
+def write_frames(sock, frames):
+    # one writev for the whole batch, looping only on partial writes
+    syscalls = 0
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(frames))
+        return 1
+    bufs = [memoryview(f) for f in frames]
+    while bufs:
+        sent = sock.sendmsg(bufs)
+        syscalls += 1
+        while bufs and sent >= len(bufs[0]):
+            sent -= len(bufs[0])
+            bufs.pop(0)
+        if sent:
+            bufs[0] = bufs[0][sent:]
+    return syscalls
+
+
+def take_batch(client: ClientInfo, limit):
+    # weighted round robin over the lanes, highest priority first in every round
+    batch = []
+    weights = settings["lane_weights"]
+    while len(batch) < limit and client.pending:
+        for idx, weight in enumerate(weights):
+            lane = client.lanes[idx]
+            for _ in range(min(weight, len(lane), limit - len(batch))):
+                queued, data, trace, seq = lane.popleft()
+                batch.append((idx, queued, data, trace, seq))
+                client.pending -= 1
+    return batch
+
+
+def writer_loop(client: ClientInfo):
+    while True:
+        with client.out_cond:
+            idle = not client.pending
+            while not client.pending and not client.closed:
+                client.out_cond.wait()
+            if not client.pending:
+                return
+            # a frame that finds the writer idle goes out at once. Frames that
+            # piled up during the last write are in a burst: let it grow for
+            # up to flush_delay, unless a reply is waiting
+            if not idle:
+                deadline = time.monotonic() + settings["flush_delay"]
+                while (not client.closed and client.pending < settings["max_batch"]
+                       and not client.lanes[LANE_REPLY]):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    client.out_cond.wait(remaining)
+            batch = take_batch(client, settings["max_batch"])
+        frames_dequeued(len(batch))
+        try:
+            syscalls = write_frames(client.sock, [data for _, _, data, _, _ in batch])
+        except OSError:
+            abandon_output(client, [e[3] for e in batch])
+            return
+        if tracer is not None:
+            for _, _, _, trace, _ in batch:
+                if trace is not None:
+                    trace.sent(client.username)
+        if capture is not None:
+            for _, _, data, _, seq in batch:
+                if seq is not None:
+                    capture.record(cap.OUT, client.conn_id, seq, data[:-1])
+        done = time.monotonic()
+        with stats_lock:
+            stats["frames_sent"] += len(batch)
+            stats["send_syscalls"] += syscalls
+            for lane, queued, _, _, _ in batch:
+                wait = done - queued
+                ls = lane_stats[lane]
+                ls["frames"] += 1
+                ls["wait_total"] += wait
+                if wait > ls["wait_max"]:
+                    ls["wait_max"] = wait
+
+
+def start_writer(client: ClientInfo):
+    client.writer = threading.Thread(target=writer_loop, args=(client,), daemon=True)
+    client.writer.start()
+
+# function to send an event to all users in a group; live_only leaves out
+# the members in digest mode
+def broadcast_event(group_name: str, event: dict, exclude_username=None, trace=None, live_only=False):
+    gdata = groups.get(group_name)
+    snap = gdata["snap"] if gdata else None
+    members = snap.members if snap else ()
+    skip = snap.digest if snap and live_only else ()
+    if skip:
+        bump_stat("digest_skipped", len(skip - {exclude_username}))
     targets = []
     with clients_lock:
         for uname in members:
             if exclude_username and uname == exclude_username:
                 continue
+            if uname in skip:
+                continue
             client = username_to_client.get(uname)
             if client:
                 targets.append(client)
+    if trace is not None:
+        trace.info["fanout"] = len(targets)
+        trace.mark("fanout")
+        trace.expect(len(targets))
     for c in targets:
-        send_json(c, event)
+        send_json(c, event, trace=trace)
 
 # function to handle the username setting process
 def handle_set_username(client, data):
     username = data.get("username")
+    token = data.get("resume")
+    if client.username is None and token and resume_session(client, token, username):
+        return
     if not username:
         send_json(client, {"type": "error", "message": "Username is required"})
         return
+    replaced = False
     with clients_lock:
         if username in username_to_client:
             send_json(client, {"type": "error", "message": "Username already taken"})
             return
+        # a name only held by a parked session goes to whoever logs in with
+        # it (e.g. the same user after a crash); without the token the old
+        # memberships cannot be resumed, so they are dropped
+        token_held = detached_users.pop(username, None)
+        if token_held is not None:
+            detached_sessions.pop(token_held, None)
+            replaced = True
         # accept username
         client.username = username
         username_to_client[username] = client
+        client.resume_token = secrets.token_urlsafe(16)
+    if replaced:
+        drop_memberships(username)
+        bump_stat("sessions_replaced")
+    send_json(client, {
+        "type": "info",
+        "subtype": "username_accepted",
+        "message": f"Username {username} accepted",
+        "username": username,
+        "resume_token": client.resume_token,
+        "resumed": False,
+        "instance": instance_id
+    })
+    handle_groups(client, {})
+
+
+# picks up a recently dropped session: same username and memberships, and
+# nobody else in its groups sees it leave or rejoin
+def resume_session(client, token, username):
+    with clients_lock:
+        old = username_to_client.get(username) if username else None
+    if old is not None and old.resume_token == token:
+        # the old connection has not noticed it is dead yet, take it over
+        disconnect_client(old, resumable=True)
+
+    with clients_lock:
+        session = detached_sessions.get(token)
+        if session is None or (username and session["username"] != username):
+            return False
+        if session["username"] in username_to_client:
+            return False
+        del detached_sessions[token]
+        detached_users.pop(session["username"], None)
+        client.username = session["username"]
+        username_to_client[client.username] = client
+        client.resume_token = secrets.token_urlsafe(16)
+    missed = []
+    with state_lock:
+        for g in session["groups"]:
+            if g in groups:
+                groups[g]["members"].add(client.username)
+                refresh_snapshot(groups[g], messages=False)
+                client.groups.add(g)
+                msgs, more = stored_messages_after(g, session["last_id"], settings["max_sync"])
+                if msgs:
+                    missed.append((g, msgs, more))
+        resumed_groups = sorted(client.groups)
+
+    bump_stat("sessions_resumed")
     send_json(client, {
         "type": "info",
         "subtype": "username_accepted",
-        "message": f"Username {username} accepted"
+        "message": f"Session for {client.username} resumed",
+        "username": client.username,
+        "resume_token": client.resume_token,
+        "resumed": True,
+        "instance": instance_id,
+        "groups": resumed_groups
     })
+    # whatever was posted while the connection was down
+    for g, msgs, more in missed:
+        send_json(client, {
+            "type": "history",
+            "group": g,
+            "messages": msgs,
+            "more": more
+        })
     handle_groups(client, {})
+    return True
+
+# messages are appended in id order, so binary search for the first id > since
+def messages_after(messages, since, limit):
+    lo, hi = 0, len(messages)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if messages[mid]["id"] <= since:
+            lo = mid + 1
+        else:
+            hi = mid
+    return messages[lo:lo + limit], len(messages) - lo > limit
+
 
 def handle_join(client, data):
+    if isinstance(data.get("groups"), list):
+        handle_join_many(client, data)
+        return
     group = data.get("group", PUBLIC_GROUP)
     if group not in groups:
         send_json(client, {"type": "error", "message": f"Unknown group: {group}"})
@@ -94,19 +813,72 @@ def handle_join(client, data):
         send_json(client, {"type": "error", "message": "Set username first"})
         return
 
+    delivery = data.get("delivery", "live")
+    if delivery not in DELIVERY_MODES:
+        send_json(client, {"type": "error", "message": "delivery must be live or digest"})
+        return
+
+    join_group(client, group, data.get("since"), delivery)
+    handle_users(client, {"group": group})
+
+
+# rejoin several groups in one request, e.g. after a reconnect; since may be
+# a {group: last seen id} map
+def handle_join_many(client, data):
+    if client.username is None:
+        send_json(client, {"type": "error", "message": "Set username first"})
+        return
+    delivery = data.get("delivery", "live")
+    if delivery not in DELIVERY_MODES:
+        send_json(client, {"type": "error", "message": "delivery must be live or digest"})
+        return
+    since = data.get("since")
+    joined = []
+    unknown = []
+    for group in data["groups"]:
+        if group not in groups:
+            unknown.append(group)
+            continue
+        join_group(client, group, since.get(group) if isinstance(since, dict) else None, delivery)
+        joined.append(group)
+
+    users = {g: groups[g]["snap"].users for g in joined}
+    send_json(client, {
+        "type": "response",
+        "command": "join",
+        "groups": joined,
+        "unknown": unknown,
+        "users": users
+    })
+
+
+def join_group(client, group, since, delivery="live"):
+    more = False
     with state_lock:
         groups[group]["members"].add(client.username)
+        # joining again switches the mode
+        if delivery == "digest":
+            groups[group]["digest"].add(client.username)
+        else:
+            groups[group]["digest"].discard(client.username)
+        if client.username not in groups[group]["cursors"]:
+            # a first join starts out with nothing unread
+            groups[group]["cursors"][client.username] = ReadCursor(next_msg_id - 1, groups[group]["snap"].total)
+        refresh_snapshot(groups[group], messages=False)
         client.groups.add(group)
-        history_msgs = groups[group]["messages"][-2:] # last 2 messages printed to connected user
+        if isinstance(since, int):
+            # client already has everything up to since, send only what it missed
+            history_msgs, more = stored_messages_after(group, since, settings["max_sync"])
+        else:
+            history_msgs = groups[group]["snap"].recent[-2:] # last 2 messages printed to connected user
 
     send_json(client, {
         "type": "history",
         "group": group,
-        "messages": history_msgs
+        "messages": history_msgs,
+        "more": more
     })
 
-    handle_users(client, {"group": group})
-
     event = {
         "type": "event",
         "event": "user_joined",
@@ -117,23 +889,47 @@ def handle_join(client, data):
 
 
 def handle_post(client, data):
-    global next_msg_id
     group = data.get("group", PUBLIC_GROUP)
     subject = data.get("subject", "")
-    body = data.get("body", "")
+    body = str(data.get("body", ""))
 
+    if not check_post(client, group):
+        return
+    size = len(body.encode("utf-8"))
+    if size > settings["max_body"]:
+        send_json(client, {
+            "type": "error",
+            "message": f"Message body too large (max {settings['max_body']} bytes, "
+                       f"larger bodies must be uploaded in chunks)"
+        })
+        return
+    publish_message(client, group, subject, body, size, data)
+
+
+def check_post(client, group):
     if client.username is None:
         send_json(client, {"type": "error", "message": "Set username first"})
-        return
+        return False
     if group not in groups:
         send_json(client, {"type": "error", "message": f"Unknown group: {group}"})
-        return
+        return False
     if group not in client.groups:
         send_json(client, {"type": "error", "message": f"You are not in group {group}"})
-        return
+        return False
+    return True
+
+
+# stores a message and tells the group; data is the request that finished it
+def publish_message(client, group, subject, body, size, data):
+    global next_msg_id, hot_bytes
+    trace = None
+    if tracer is not None and (data.get("trace") is True or random.random() < settings["trace_sample"]):
+        trace = tracer.new_trace(client)
 
     timestamp = datetime.now().isoformat(timespec="seconds")
     with state_lock:
+        if trace is not None:
+            trace.mark("locked")
         msg_id = next_msg_id
         next_msg_id += 1
         msg = {
@@ -141,10 +937,28 @@ def handle_post(client, data):
             "sender": client.username,
             "group": group,
             "subject": subject,
-            "body": body,
+            "size": size,
             "timestamp": timestamp
         }
+        total_before = groups[group]["snap"].total
         groups[group]["messages"].append(msg)
+        bodies[msg_id] = body
+        # the poster has read their own post if they were caught up
+        cursor = groups[group]["cursors"].get(client.username)
+        if cursor is not None and cursor.read == total_before:
+            cursor.last = msg_id
+            cursor.read = total_before + 1
+        hot_bytes += message_cost(msg)
+        over_budget = settings["memory_budget"] and hot_bytes > settings["memory_budget"]
+        refresh_snapshot(groups[group], members=False)
+        digest_full = False
+        if groups[group]["digest"]:
+            pending = groups[group]["pending_digest"]
+            pending.append({"id": msg_id, "sender": client.username, "subject": subject,
+                            "size": size, "date": timestamp})
+            digest_full = len(pending) >= settings["digest_max"]
+        if trace is not None:
+            trace.mark("stored")
 
     event = {
         "type": "event",
@@ -153,9 +967,145 @@ def handle_post(client, data):
         "id": msg_id,
         "sender": client.username,
         "subject": subject,
+        "size": size,
         "date": timestamp
     }
-    broadcast_event(group, event)
+    reply = {
+        "type": "response",
+        "command": "post",
+        "group": group,
+        "id": msg_id
+    }
+    if trace is not None:
+        trace.info.update(msg_id=msg_id, group=group, sender=client.username)
+        # receivers may echo it back with a trace_ack
+        event["trace"] = reply["trace"] = trace.id
+    broadcast_event(group, event, trace=trace, live_only=True)
+    send_json(client, reply)
+    if digest_full:
+        flush_digest(group)
+    if over_budget:
+        # after the reply is queued, so the poster does not wait for the disk
+        spill_messages()
+
+
+# one digest event listing the posts since the last one, to the group's
+# digest members
+def flush_digest(group):
+    with state_lock:
+        gdata = groups[group]
+        pending = gdata["pending_digest"]
+        if not pending:
+            return
+        gdata["pending_digest"] = []
+        targets = gdata["snap"].digest
+    if not targets:
+        return
+    event = {
+        "type": "event",
+        "event": "digest",
+        "group": group,
+        "count": len(pending),
+        "messages": pending
+    }
+    with clients_lock:
+        clients_to = [username_to_client[u] for u in targets if u in username_to_client]
+    for c in clients_to:
+        send_json(c, event)
+    bump_stat("digests_sent", len(clients_to))
+
+
+def digest_loop():
+    while not server_stop_event.wait(settings["digest_interval"]):
+        for group in list(groups):
+            flush_digest(group)
+
+
+# chunked upload: post_begin announces the size in bytes, post_chunk frames
+# carry the body in order and are acked one by one (the client keeps at most
+# upload_window unacked), post_end publishes it like a normal post
+def handle_post_begin(client, data):
+    group = data.get("group", PUBLIC_GROUP)
+    size = data.get("size")
+    if not check_post(client, group):
+        return
+    if not isinstance(size, int) or size < 0:
+        send_json(client, {"type": "error", "message": "size must be the body length in bytes"})
+        return
+    if size > settings["max_upload"]:
+        send_json(client, {"type": "error",
+                           "message": f"Message body too large (max {settings['max_upload']} bytes)"})
+        return
+    if len(client.uploads) >= settings["max_uploads"]:
+        send_json(client, {"type": "error", "message": "Too many uploads in progress"})
+        return
+    client.next_upload += 1
+    upload = client.next_upload
+    client.uploads[upload] = {
+        "group": group,
+        "subject": data.get("subject", ""),
+        "size": size,
+        "parts": [],
+        "received": 0,
+        "seq": 0,
+    }
+    send_json(client, {
+        "type": "response",
+        "command": "post_begin",
+        "upload": upload,
+        "chunk_size": settings["chunk_size"],
+        "window": settings["upload_window"]
+    })
+
+
+def handle_post_chunk(client, data):
+    upload = data.get("upload")
+    up = client.uploads.get(upload)
+    chunk = data.get("data")
+    if up is None:
+        send_json(client, {"type": "error", "message": f"Unknown upload: {upload}"})
+        return
+    error = None
+    if not isinstance(chunk, str) or len(chunk) > settings["chunk_size"]:
+        error = f"Chunks must be strings of at most {settings['chunk_size']} characters"
+    elif data.get("seq") != up["seq"]:
+        error = f"Expected chunk {up['seq']}, got {data.get('seq')}"
+    else:
+        n = len(chunk.encode("utf-8"))
+        if up["received"] + n > up["size"]:
+            error = f"Upload is larger than the announced {up['size']} bytes"
+    if error:
+        # the upload cannot recover from a bad chunk, start over
+        del client.uploads[upload]
+        send_json(client, {"type": "error", "message": error, "upload": upload})
+        return
+    up["parts"].append(chunk)
+    up["received"] += n
+    up["seq"] += 1
+    send_json(client, {
+        "type": "response",
+        "command": "post_chunk",
+        "upload": upload,
+        "seq": up["seq"] - 1,
+        "received": up["received"]
+    })
+
+
+def handle_post_end(client, data):
+    upload = data.get("upload")
+    up = client.uploads.pop(upload, None)
+    if up is None:
+        send_json(client, {"type": "error", "message": f"Unknown upload: {upload}"})
+        return
+    if up["received"] != up["size"]:
+        send_json(client, {"type": "error", "upload": upload,
+                           "message": f"Upload incomplete: {up['received']} of {up['size']} bytes"})
+        return
+    if not check_post(client, up["group"]):
+        return
+    body = "".join(up["parts"])
+    up["parts"] = None
+    publish_message(client, up["group"], up["subject"], body, up["size"], data)
 
 
 def handle_users(client, data):
@@ -167,28 +1117,26 @@ def handle_users(client, data):
         send_json(client, {"type": "error", "message": "Set username first"})
         return
 
-    with state_lock:
-        members = groups[group]["members"]
-        # check if user is a part of the group or not
-        if client.username not in members:
-            send_json(client, {
-                "type": "error",
-                "message": f"You are not in group {group}"
-            })
-            return
-        user_list = sorted(members)
+    snap = groups[group]["snap"]
+    # check if user is a part of the group or not
+    if client.username not in snap.members:
+        send_json(client, {
+            "type": "error",
+            "message": f"You are not in group {group}"
+        })
+        return
 
     send_json(client, {
         "type": "response",
         "command": "users",
         "group": group,
-        "users": user_list
+        "users": snap.users
     })
 
 
 def handle_groups(client, data):
-    with state_lock:
-        all_groups = sorted(groups.keys())
+    # the set of groups is fixed once init_groups has run
+    all_groups = sorted(groups.keys())
     send_json(client, {
         "type": "response",
         "command": "groups",
@@ -202,10 +1150,13 @@ def handle_leave(client, data):
         send_json(client, {"type": "error", "message": f"Unknown group: {group}"})
         return
     if client.username is None:
+        send_json(client, {"type": "error", "message": "Set username first"})
         return
     with state_lock:
         if client.username in groups[group]["members"]:
             groups[group]["members"].remove(client.username)
+            groups[group]["digest"].discard(client.username)
+            refresh_snapshot(groups[group], messages=False)
         if group in client.groups:
             client.groups.remove(group)
     event = {
@@ -215,109 +1166,501 @@ def handle_leave(client, data):
         "user": client.username
     }
     broadcast_event(group, event, exclude_username=client.username)
+    send_json(client, {
+        "type": "response",
+        "command": "leave",
+        "group": group
+    })
 
-def handle_get_message(client, data):
-    group = data.get("group", PUBLIC_GROUP)
-    msg_id = data.get("id")
+# the (headers, body) of a message the client may read, or None after
+# telling it why not
+def lookup_message(client, group, msg_id):
     if group not in groups:
         send_json(client, {"type": "error", "message": f"Unknown group: {group}"})
-        return
+        return None
     if msg_id is None:
         send_json(client, {"type": "error", "message": "Message ID required"})
-        return
+        return None
     if client.username is None:
         send_json(client, {"type": "error", "message": "Set username first"})
-        return
+        return None
 
-    with state_lock:
-        members = groups[group]["members"]
-        if client.username not in members:
-            send_json(client, {
-                "type": "error",
-                "message": f"You are not in group {group}"
-            })
-            return
-
-        messages = groups[group]["messages"]
-        found = None
-        for m in messages:
-            if m["id"] == msg_id:
-                found = m
-                break
+    found = None
+    snap = groups[group]["snap"]
+    if client.username not in snap.members:
+        send_json(client, {
+            "type": "error",
+            "message": f"You are not in group {group}"
+        })
+        return None
+    if isinstance(msg_id, int):
+        if snapshot_covers(snap, msg_id):
+            found = find_message(snap.recent, msg_id)
+        else:
+            with state_lock:
+                found = find_stored(group, msg_id)
+    # bodies are stored before the snapshot that lists them is published, and
+    # spilled before they are dropped from memory
+    body = None
+    if found:
+        body = bodies.get(msg_id)
+        if body is None:
+            body = store.body(group, msg_id)
+            bump_stat("cold_hits")
+        else:
+            bump_stat("hot_hits")
 
     if not found:
         send_json(client, {
             "type": "error",
             "message": f"No message with ID {msg_id} in group {group}"
         })
-        return
+        return None
+    return found, body
+
+
+# messages are in id order, binary search like messages_after
+def find_message(messages, msg_id):
+    lo, hi = 0, len(messages)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if messages[mid]["id"] < msg_id:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(messages) and messages[lo]["id"] == msg_id:
+        return messages[lo]
+    return None
+
 
+def handle_get_message(client, data):
+    group = data.get("group", PUBLIC_GROUP)
+    result = lookup_message(client, group, data.get("id"))
+    if result is None:
+        return
+    found, body = result
+    if found["size"] > settings["inline_body"]:
+        # too big for one frame, the client pulls it with get_chunk
+        send_json(client, {
+            "type": "response",
+            "command": "message",
+            "group": group,
+            "message": found,
+            "chunked": True,
+            "chars": len(body),
+            "chunk_size": settings["chunk_size"]
+        })
+        return
     send_json(client, {
         "type": "response",
         "command": "message",
         "group": group,
-        "message": found
+        "message": dict(found, body=body)
+    })
+
+
+# one slice of a body, offset and length in characters. Clients keep a few
+# requests in flight, so a big download never floods the connection
+def handle_get_chunk(client, data):
+    group = data.get("group", PUBLIC_GROUP)
+    offset = data.get("offset", 0)
+    if not isinstance(offset, int) or offset < 0:
+        send_json(client, {"type": "error", "message": "offset must be a character offset"})
+        return
+    result = lookup_message(client, group, data.get("id"))
+    if result is None:
+        return
+    found, body = result
+    piece = body[offset:offset + settings["chunk_size"]]
+    send_json(client, {
+        "type": "response",
+        "command": "chunk",
+        "group": group,
+        "id": found["id"],
+        "offset": offset,
+        "data": piece,
+        "eof": offset + len(piece) >= len(body)
+    })
+
+def handle_sync(client, data):
+    group = data.get("group", PUBLIC_GROUP)
+    since = data.get("since", 0)
+    if group not in groups:
+        send_json(client, {"type": "error", "message": f"Unknown group: {group}"})
+        return
+    if client.username is None:
+        send_json(client, {"type": "error", "message": "Set username first"})
+        return
+    if not isinstance(since, int):
+        send_json(client, {"type": "error", "message": "since must be a message ID"})
+        return
+
+    if client.username not in groups[group]["snap"].members:
+        send_json(client, {
+            "type": "error",
+            "message": f"You are not in group {group}"
+        })
+        return
+    msgs, more = read_messages_after(group, since, settings["max_sync"])
+
+    send_json(client, {
+        "type": "response",
+        "command": "sync",
+        "group": group,
+        "messages": msgs,
+        "more": more
     })
 
-def disconnect_client(client: ClientInfo):
+
+# moves the user's read cursor in a group forward to id (default: the newest
+# message); it never moves back
+def handle_ack(client, data):
+    group = data.get("group", PUBLIC_GROUP)
+    msg_id = data.get("id")
+    if group not in groups:
+        send_json(client, {"type": "error", "message": f"Unknown group: {group}"})
+        return
+    if client.username is None:
+        send_json(client, {"type": "error", "message": "Set username first"})
+        return
+    if msg_id is not None and not isinstance(msg_id, int):
+        send_json(client, {"type": "error", "message": "id must be a message ID"})
+        return
+    if client.username not in groups[group]["snap"].members:
+        send_json(client, {"type": "error", "message": f"You are not in group {group}"})
+        return
+
+    with state_lock:
+        gdata = groups[group]
+        newest = next_msg_id - 1
+        msg_id = newest if msg_id is None else min(msg_id, newest)
+        cursor = gdata["cursors"].get(client.username)
+        if cursor is None:
+            cursor = gdata["cursors"][client.username] = ReadCursor(0, 0)
+        if msg_id > cursor.last:
+            cursor.last = msg_id
+            cursor.read = count_upto(group, msg_id)
+            cursor.first_unread = None
+        last = cursor.last
+        unread = gdata["snap"].total - cursor.read
+
+    send_json(client, {
+        "type": "response",
+        "command": "ack",
+        "group": group,
+        "id": last,
+        "unread": unread
+    })
+
+
+# unread count and first unread message id for every group the user is in
+def handle_unread(client, data):
+    if client.username is None:
+        send_json(client, {"type": "error", "message": "Set username first"})
+        return
+    result = {}
+    with state_lock:
+        for group in sorted(client.groups):
+            gdata = groups[group]
+            cursor = gdata["cursors"].get(client.username)
+            if cursor is None:
+                continue
+            unread = gdata["snap"].total - cursor.read
+            if unread and cursor.first_unread is None:
+                msgs, _ = stored_messages_after(group, cursor.last, 1)
+                cursor.first_unread = msgs[0]["id"] if msgs else None
+            result[group] = {
+                "unread": unread,
+                "first_unread": cursor.first_unread if unread else None
+            }
+
+    send_json(client, {
+        "type": "response",
+        "command": "unread",
+        "groups": result
+    })
+
+
+def handle_stats(client, data):
+    with stats_lock:
+        snapshot = dict(stats)
     with clients_lock:
-        if client in clients:
-            clients.remove(client)
-        if client.username and username_to_client.get(client.username) == client:
-            del username_to_client[client.username]
+        snapshot["connections"] = len(clients)
+        snapshot["usernames"] = len(username_to_client)
+    snapshot["threads"] = threading.active_count()
+    snapshot["queued_frames"] = queued_frames
+    snapshot["lock_wait_ms"] = round(1000 * state_lock.avg_wait, 3)
+    with stats_lock:
+        snapshot["lanes"] = {
+            name: {
+                "frames": ls["frames"],
+                "avg_wait_ms": round(1000 * ls["wait_total"] / ls["frames"], 3) if ls["frames"] else 0.0,
+                "max_wait_ms": round(1000 * ls["wait_max"], 3),
+            }
+            for name, ls in zip(LANE_NAMES, lane_stats)
+        }
+    # message reads served from memory vs from the segment files
+    hot_hits = snapshot.pop("hot_hits", 0)
+    cold_hits = snapshot.pop("cold_hits", 0)
+    storage = {
+        "hot_messages": sum(len(g["messages"]) for g in groups.values()),
+        "hot_bytes": hot_bytes,
+        "memory_budget": settings["memory_budget"],
+        "hot_hits": hot_hits,
+        "cold_hits": cold_hits,
+        "hot_hit_rate": round(hot_hits / (hot_hits + cold_hits), 4) if hot_hits + cold_hits else None,
+    }
+    if store is not None:
+        storage.update(store.stats())
+    snapshot["storage"] = storage
+    send_json(client, {
+        "type": "response",
+        "command": "stats",
+        "stats": snapshot
+    })
 
-    if client.username:
+# removes a user from every group and tells the other members; returns the
+# number of memberships dropped
+def drop_memberships(username):
+    dropped = 0
+    with state_lock:
+        groups_and_members = list(groups.items())
+    for gname, gdata in groups_and_members:
         with state_lock:
-            groups_and_members = list(groups.items())
-        for gname, gdata in groups_and_members:
-            with state_lock:
-                if client.username in gdata["members"]:
-                    gdata["members"].remove(client.username)
-            event = {
-                "type": "event",
-                "event": "user_left",
-                "group": gname,
-                "user": client.username
+            if username in gdata["members"]:
+                gdata["members"].remove(username)
+                gdata["digest"].discard(username)
+                refresh_snapshot(gdata, messages=False)
+                dropped += 1
+        event = {
+            "type": "event",
+            "event": "user_left",
+            "group": gname,
+            "user": username
+        }
+        broadcast_event(gname, event, exclude_username=username)
+    return dropped
+
+
+# resumable: the connection dropped rather than exited, so the memberships are
+# parked for resume_window seconds instead of being dropped right away
+# flush=False skips waiting for queued output, for peers that stopped
+# reading (a writer stuck in sendmsg would hold the caller for
+# close_flush_timeout)
+def disconnect_client(client: ClientInfo, resumable=False, flush=True):
+    keep = False
+    with clients_lock:
+        # the reaper and the client's own thread can both get here
+        with client.out_cond:
+            if client.disconnected:
+                return
+            client.disconnected = True
+            client.closed = True
+            client.out_cond.notify()
+        if client.username and username_to_client.get(client.username) == client:
+            del username_to_client[client.username]
+            keep = resumable and client.resume_token and settings["resume_window"] > 0
+        if keep:
+            detached_sessions[client.resume_token] = {
+                "username": client.username,
+                "groups": set(client.groups),
+                "last_id": next_msg_id - 1,
+                "expires": time.monotonic() + settings["resume_window"],
             }
-            broadcast_event(gname, event, exclude_username=client.username)
+            detached_users[client.username] = client.resume_token
 
+    if keep:
+        bump_stat("sessions_detached")
+    elif client.username:
+        drop_memberships(client.username)
+
+    # give the writer a bounded chance to flush what is already queued
+    if flush and client.writer and client.writer is not threading.current_thread():
+        client.writer.join(settings["close_flush_timeout"])
+
+    # shutdown first so a thread blocked reading this socket wakes up
+    try:
+        client.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
     try:
         client.sock.close()
     except OSError:
         pass
+    if capture is not None:
+        capture.record(cap.CLOSE, client.conn_id, client.in_seq)
+    # only forget the client once it is fully closed, so shutdown can wait on it
+    with clients_lock:
+        clients.discard(client)
     print(f"Client disconnected: {client.addr} ({client.username})")
 
 
+def expire_sessions(now):
+    with clients_lock:
+        expired = [(t, s) for t, s in detached_sessions.items() if s["expires"] <= now]
+        for token, session in expired:
+            del detached_sessions[token]
+            if detached_users.get(session["username"]) == token:
+                del detached_users[session["username"]]
+    for _, session in expired:
+        dropped = drop_memberships(session["username"])
+        bump_stat("sessions_expired")
+        bump_stat("memberships_reclaimed", dropped)
+
+
+def reap_client(client: ClientInfo):
+    memberships = sum(1 for g in groups.values() if client.username in g["snap"].members)
+    username = client.username
+    # it has sent nothing for idle_timeout, so nothing queued is worth waiting for
+    disconnect_client(client, flush=False)
+    bump_stat("connections_reaped")
+    bump_stat("memberships_reclaimed", memberships)
+    if username:
+        bump_stat("usernames_reclaimed")
+    print(f"Reaped idle client {client.addr} ({username})")
+
+# sends pings to quiet clients and reaps the ones that stopped answering
+def heartbeat_loop():
+    while True:
+        tick = max(0.05, min(settings["ping_interval"], settings["idle_timeout"]) / 4)
+        if server_stop_event.wait(tick):
+            return
+        now = time.monotonic()
+        expire_sessions(now)
+        with clients_lock:
+            current_clients = list(clients)
+        for c in current_clients:
+            if c.closed:
+                continue
+            idle = now - c.last_seen
+            if idle >= settings["idle_timeout"]:
+                reap_client(c)
+            elif idle >= settings["ping_interval"] and now - c.last_ping >= settings["ping_interval"]:
+                c.last_ping = now
+                send_json(c, {"type": "ping"})
+                bump_stat("pings_sent")
+
+
+# the rest of a transfer that post_begin or get_message already let in.
+# Refusing one would break the chunk order, so these wait for their token
+# (and for an overload to pass) instead, which stops reading from the client.
+PACED_ACTIONS = {"post_chunk", "get_chunk", "post_end"}
+# never throttled or shed
+CONTROL_ACTIONS = {"pong", "ping", "trace_ack", "stats", "exit", "shutdown"}
+
+
+def overloaded():
+    return queued_frames > settings["shed_queue_depth"] or state_lock.avg_wait > settings["shed_lock_wait"]
+
+
+# per-client token bucket first, then server-wide overload; returns True
+# if the request may run
+def admit(client: ClientInfo, action):
+    if action in CONTROL_ACTIONS:
+        return True
+    limit = settings["rate_limits"].get(action)
+    bucket = None
+    if limit is not None:
+        bucket = client.buckets.get(action)
+        if bucket is None:
+            bucket = client.buckets[action] = TokenBucket(*limit)
+    if action in PACED_ACTIONS:
+        wait = bucket.take() if bucket is not None else 0.0
+        while wait:
+            bump_stat("paced")
+            if server_stop_event.wait(wait):
+                return False
+            wait = bucket.take()
+        while overloaded():
+            bump_stat("paced")
+            if server_stop_event.wait(settings["shed_retry_after"]):
+                return False
+        return True
+    wait = bucket.take() if bucket is not None else 0.0
+    if wait:
+        bump_stat("throttled")
+        send_json(client, {
+            "type": "error",
+            "code": "rate_limited",
+            "action": action,
+            "retry_after": round(wait, 3),
+            "message": f"Rate limit exceeded for {action}, retry in {wait:.2f}s"
+        })
+        return False
+    if overloaded():
+        bump_stat("shed")
+        retry = settings["shed_retry_after"]
+        send_json(client, {
+            "type": "error",
+            "code": "overloaded",
+            "action": action,
+            "retry_after": retry,
+            "message": f"Server overloaded, retry in {retry:.2f}s"
+        })
+        return False
+    return True
+
+
 def handle_client(client: ClientInfo):
     sock = client.sock
     addr = client.addr
     print(f"New connection from {addr}")
+    start_writer(client)
     send_json(client, {
         "type": "info",
-        "message": "Welcome to the Bulletin Board. Please set your username."
+        "message": "Welcome to the Bulletin Board. Please set your username.",
+        "instance": instance_id
     })
-    f = sock.makefile("r")
+    framer = LineFramer(settings["max_frame"])
+    # only a connection that drops without saying exit can be resumed
+    resumable = True
+
+    def on_oversize(err):
+        send_json(client, {"type": "error", "message": f"Request too large: {err}"})
+
     try:
-        for line in f:
-            line = line.strip()
+        for frame in iter_frames(sock, framer, on_oversize):
+            client.last_seen = time.monotonic()
+            if tracer is not None:
+                client.t_read = time.monotonic_ns()
+            client.req = None
+            line = frame.strip()
             if not line:
                 continue
+            client.in_seq += 1
+            if capture is not None:
+                capture.record(cap.IN, client.conn_id, client.in_seq, line)
             try:
                 data = json.loads(line)
-            except json.JSONDecodeError:
+            except ValueError:
                 send_json(client, {"type": "error", "message": "Invalid JSON"})
                 continue
+            if tracer is not None:
+                client.t_parsed = time.monotonic_ns()
+            client.req = data.get("req")
             action = data.get("action")
             if not action:
                 send_json(client, {"type": "error", "message": "Missing action"})
                 continue
+            if not admit(client, action):
+                continue
 
-            if action == "set_username":
+            if action == "pong":
+                bump_stat("pongs_received")
+            elif action == "ping":
+                send_json(client, {"type": "pong"})
+            elif action == "set_username":
                 handle_set_username(client, data)
             elif action == "join":
                 handle_join(client, data)
             elif action == "post":
                 handle_post(client, data)
+            elif action == "post_begin":
+                handle_post_begin(client, data)
+            elif action == "post_chunk":
+                handle_post_chunk(client, data)
+            elif action == "post_end":
+                handle_post_end(client, data)
             elif action == "users":
                 handle_users(client, data)
             elif action == "groups":
@@ -331,62 +1674,309 @@ def handle_client(client: ClientInfo):
                     except ValueError:
                         pass
                 handle_get_message(client, data)
+            elif action == "get_chunk":
+                handle_get_chunk(client, data)
+            elif action == "sync":
+                handle_sync(client, data)
+            elif action == "ack":
+                handle_ack(client, data)
+            elif action == "unread":
+                handle_unread(client, data)
+            elif action == "stats":
+                handle_stats(client, data)
+            elif action == "trace_ack":
+                # a receiver got a traced new_message
+                if tracer is not None:
+                    tracer.write({"trace": data.get("trace"), "ack": client.username,
+                                  "t_ns": client.t_read})
             elif action == "exit":
+                resumable = False
                 break
             elif action == "shutdown":
                 print(f"Shutdown requested by {client.username} from {client.addr}")
                 send_json(client, {"type": "info", "message": "Server shutting down."})
-                server_stop_event.set()
+                stop_server()
+                resumable = False
                 break
             else:
                 send_json(client, {"type": "error", "message": f"Unknown action: {action}"})
     except Exception as e:
-        print(f"Error with client {addr}: {e}")
+        if not client.closed:
+            print(f"Error with client {addr}: {e}")
     finally:
-        disconnect_client(client)
+        disconnect_client(client, resumable=resumable)
+
 
+# connection ids for capture, shared by all listeners
+conn_ids = itertools.count(1)
+
+
+def open_unix_listener(path):
+    # a socket file left behind by a server that died can be reused. One a
+    # live server still accepts on, or anything that is not a socket, is
+    # not ours to remove
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            else:
+                raise OSError(errno.EADDRINUSE, f"Address already in use: {path}")
+            finally:
+                probe.close()
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(settings["backlog"])
+    return sock
+
+
+# sets the stop event and wakes the accept loop, which would otherwise sleep
+# until the next connection
+def stop_server():
+    server_stop_event.set()
+    if wakeup is not None:
+        try:
+            wakeup.send(b"\0")
+        except OSError:
+            pass
 
-def run_server(port: int):
+
+def refuse_connection(sock):
+    bump_stat("connections_refused")
+    frame = {
+        "type": "error",
+        "code": "server_full",
+        "message": "Server is full, try again later.",
+        "retry_after": settings["shed_retry_after"],
+    }
+    try:
+        sock.setblocking(False)
+        sock.send((json.dumps(frame) + "\n").encode("utf-8"))
+    except OSError:
+        pass
+    sock.close()
+
+
+def accept_ready(srv_sock):
+    unix = srv_sock.family == getattr(socket, "AF_UNIX", None)
+    # take everything waiting in the backlog, not one connection per wakeup
+    while True:
+        try:
+            client_sock, addr = srv_sock.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # out of file descriptors or similar; the rest stay in the backlog
+            print(f"Accept failed: {e}")
+            time.sleep(0.1)
+            return
+
+        with clients_lock:
+            full = 0 < settings["max_connections"] <= len(clients)
+        if full:
+            refuse_connection(client_sock)
+            continue
+        client_sock.setblocking(True)
+        if unix:
+            # unix peers have no address of their own
+            addr = "unix:" + srv_sock.getsockname()
+        else:
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = ClientInfo(client_sock, addr)
+        client.conn_id = next(conn_ids)
+        if capture is not None:
+            capture.record(cap.OPEN, client.conn_id, 0, str(addr).encode("utf-8"))
+        with clients_lock:
+            clients.add(client)
+        t = threading.Thread(target=handle_client, args=(client,), daemon=True)
+        t.start()
+
+
+# one loop for all listeners; blocks in select until a connection arrives or
+# stop_server() writes to wake_sock
+def accept_loop(listeners, wake_sock):
+    sel = selectors.DefaultSelector()
+    for srv_sock in listeners:
+        srv_sock.setblocking(False)
+        sel.register(srv_sock, selectors.EVENT_READ)
+    sel.register(wake_sock, selectors.EVENT_READ)
+    try:
+        while not server_stop_event.is_set():
+            for key, _ in sel.select():
+                if key.fileobj is not wake_sock:
+                    accept_ready(key.fileobj)
+    finally:
+        sel.close()
+
+
+# closes every connection at shutdown. Unlike disconnect_client nobody is told
+# about the others leaving, and the writers flush what is already queued all
+# at once, bounded by one shared deadline. Returns (connections closed,
+# connections whose output did not make it out in time).
+def drain_clients(timeout):
+    with clients_lock:
+        current = list(clients)
+    deadline = time.monotonic() + timeout
+    for c in current:
+        # closed first, so the reader threads that see EOF below leave the
+        # client to us instead of running disconnect_client
+        with c.out_cond:
+            c.closed = True
+            c.disconnected = True
+            c.out_cond.notify()
+        try:
+            c.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+    for c in current:
+        if c.writer and c.writer is not threading.current_thread():
+            c.writer.join(max(0.0, deadline - time.monotonic()))
+    late = 0
+    for c in current:
+        if c.writer and c.writer.is_alive():
+            late += 1
+        # also wakes a writer still blocked on a client that stopped reading
+        try:
+            c.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            c.sock.close()
+        except OSError:
+            pass
+        if capture is not None:
+            capture.record(cap.CLOSE, c.conn_id, c.in_seq)
+    with clients_lock:
+        for c in current:
+            clients.discard(c)
+            if c.username and username_to_client.get(c.username) == c:
+                del username_to_client[c.username]
+    return len(current), late
+
+
+# unix_path: also accept connections on this Unix domain socket; both
+# listeners share all server state
+def run_server(port: int, ping_interval=None, idle_timeout=None, unix_path=None):
+    global wakeup
+    if ping_interval is not None:
+        settings["ping_interval"] = ping_interval
+    if idle_timeout is not None:
+        settings["idle_timeout"] = idle_timeout
     init_groups()
     srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     srv_sock.bind(("0.0.0.0", port))
-    srv_sock.listen()
-    srv_sock.settimeout(1.0)
+    srv_sock.listen(settings["backlog"])
+    listeners = [srv_sock]
+    if unix_path:
+        listeners.append(open_unix_listener(unix_path))
+    wake_sock, wakeup = socket.socketpair()
+    wakeup.setblocking(False)
 
     print(f"Server listening on port {port}... (Ctrl+C to stop)")
+    if unix_path:
+        print(f"Also listening on {unix_path}")
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+    threading.Thread(target=digest_loop, daemon=True).start()
 
     try:
-        while not server_stop_event.is_set():
-            try:
-                client_sock, addr = srv_sock.accept()
-            except socket.timeout:
-                continue
-
-            client = ClientInfo(client_sock, addr)
-            with clients_lock:
-                clients.add(client)
-            t = threading.Thread(target=handle_client, args=(client,), daemon=True)
-            t.start()
-
+        accept_loop(listeners, wake_sock)
     except KeyboardInterrupt:
         print("\nKeyboardInterrupt received, shutting down server...")
         server_stop_event.set()
     finally:
         print("Closing listening socket...")
-        try:
-            srv_sock.close()
-        except OSError:
-            pass
+        for srv in listeners:
+            try:
+                srv.close()
+            except OSError:
+                pass
+        if unix_path:
+            try:
+                os.unlink(unix_path)
+            except OSError:
+                pass
 
-        with clients_lock:
-            current_clients = list(clients)
-        for c in current_clients:
-            disconnect_client(c)
+        started = time.monotonic()
+        closed, late = drain_clients(settings["shutdown_timeout"])
+        print(f"Closed {closed} connections in {time.monotonic() - started:.2f}s"
+              + (f", {late} with output still unsent" if late else ""))
+        wakeup.close()
+        wake_sock.close()
+        if capture is not None:
+            capture.close()
+            print(f"Capture written to {capture.path} ({capture.records} records)")
+        if tracer is not None:
+            tracer.close()
+            print(f"Traces written to {tracer.path} ({tracer.records} records)")
+        if store is not None:
+            store.close()
         print("Server stopped.")
 
 if __name__ == "__main__":
-    port = DEFAULT_PORT
-    if len(sys.argv) >= 2:
-        port = int(sys.argv[1])
-    run_server(port)
+    parser = argparse.ArgumentParser(description="Bulletin board server")
+    parser.add_argument("port", nargs="?", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--ping-interval", type=float, default=settings["ping_interval"],
+                        help="seconds of silence before a client is pinged")
+    parser.add_argument("--idle-timeout", type=float, default=settings["idle_timeout"],
+                        help="seconds of silence before a client is disconnected")
+    parser.add_argument("--resume-window", type=float, default=settings["resume_window"],
+                        help="seconds a dropped session can be resumed (0 disables)")
+    parser.add_argument("--max-frame", type=int, default=settings["max_frame"],
+                        help="longest request line accepted, in bytes")
+    parser.add_argument("--max-body", type=int, default=settings["max_body"],
+                        help="longest post body accepted, in bytes")
+    parser.add_argument("--flush-delay", type=float, default=settings["flush_delay"],
+                        help="max seconds to let a burst of outgoing frames grow before writing it")
+    parser.add_argument("--no-rate-limits", action="store_true",
+                        help="turn off per-client rate limits (bulk loads, benchmarks)")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="record every request (and the replies to it) to PATH for replay.py")
+    parser.add_argument("--trace-file", metavar="PATH",
+                        help="write post latency traces to PATH as JSON lines")
+    parser.add_argument("--trace-sample", type=float, default=settings["trace_sample"],
+                        help="fraction of posts to trace with --trace-file")
+    parser.add_argument("--unix", metavar="PATH",
+                        help="also listen on this Unix domain socket, for clients on the same host")
+    parser.add_argument("--backlog", type=int, default=settings["backlog"],
+                        help="listen() backlog of pending connections")
+    parser.add_argument("--max-connections", type=int, default=settings["max_connections"],
+                        help="refuse connections beyond this many (0 = no limit)")
+    parser.add_argument("--memory-budget", type=float, default=settings["memory_budget"] / (1 << 20),
+                        help="MiB of messages kept in memory before old ones are spilled to disk (0 = never)")
+    parser.add_argument("--spill-dir", metavar="DIR",
+                        help="directory for spilled message segments (default: a temp dir)")
+    parser.add_argument("--shutdown-timeout", type=float, default=settings["shutdown_timeout"],
+                        help="seconds to wait for queued output when shutting down")
+    parser.add_argument("--digest-interval", type=float, default=settings["digest_interval"],
+                        help="seconds between digests for members joined in digest mode")
+    parser.add_argument("--digest-max", type=int, default=settings["digest_max"],
+                        help="send a digest early once this many posts are waiting")
+    parser.add_argument("--max-pending", type=int, default=settings["max_pending"],
+                        help="frames queued for one client before it is disconnected as too slow (0 = no cap)")
+    args = parser.parse_args()
+    settings["trace_sample"] = args.trace_sample
+    if args.trace_file:
+        tracer = TraceLog(args.trace_file)
+    if args.capture:
+        capture = cap.CaptureWriter(args.capture)
+    if args.no_rate_limits:
+        settings["rate_limits"] = {}
+    settings["flush_delay"] = args.flush_delay
+    settings["max_frame"] = args.max_frame
+    settings["max_body"] = args.max_body
+    settings["resume_window"] = args.resume_window
+    settings["backlog"] = args.backlog
+    settings["max_connections"] = args.max_connections
+    settings["shutdown_timeout"] = args.shutdown_timeout
+    settings["memory_budget"] = int(args.memory_budget * (1 << 20))
+    settings["spill_dir"] = args.spill_dir
+    settings["digest_interval"] = args.digest_interval
+    settings["digest_max"] = args.digest_max
+    settings["max_pending"] = args.max_pending
+    run_server(args.port, ping_interval=args.ping_interval, idle_timeout=args.idle_timeout,
+               unix_path=args.unix)